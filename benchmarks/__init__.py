@@ -0,0 +1 @@
+"""Benchmarks for WebHaiku's performance-sensitive code paths"""
@@ -0,0 +1,53 @@
+"""Compare rows/sec for ``DB.executemany()`` batch sizes w/one-at-a-time inserts
+
+Run ``python -m benchmarks.db [rows]`` from the source directory.
+"""
+import os, shutil, sqlite3, sys, tempfile, time
+from web_haiku import DB
+
+class FileDB(DB):
+    path = None
+    def db_connect(self):
+        return sqlite3.connect(self.path)
+
+def make_db(directory, name):
+    db = FileDB()
+    db.path = os.path.join(directory, name + '.db')
+    db.cursor("CREATE TABLE items (id INTEGER, name TEXT, price REAL)")
+    return db
+
+def rows(count):
+    for n in xrange(count):
+        yield n, 'Item #%d' % n, n * 0.25
+
+def one_at_a_time(db, count):
+    start = time.time()
+    for row in rows(count):
+        db.cursor("INSERT INTO items VALUES (?, ?, ?)", row)
+        db.get_db().commit()
+    return count / (time.time() - start)
+
+def batched(db, count, batch_size):
+    return db.executemany(
+        "INSERT INTO items VALUES (?, ?, ?)", rows(count), batch_size
+    )['rows_per_sec']
+
+def main(count=20000):
+    directory = tempfile.mkdtemp()
+    try:
+        print "%-20s %12.0f rows/sec" % (
+            "autocommit (1/10)", one_at_a_time(make_db(directory, 'one'),
+            count // 10)
+        )
+        for batch_size in 1, 10, 100, 500, 1000, 5000:
+            print "%-20s %12.0f rows/sec" % (
+                "batch_size=%d" % batch_size, batched(
+                    make_db(directory, 'batch%d' % batch_size), count,
+                    batch_size
+                )
+            )
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,77 @@
+"""Compare the per-POST cost of WebHaiku's form parsing w/``cgi.FieldStorage``
+
+Run ``python -m benchmarks.forms`` from the source directory.  Both ways of
+parsing are timed on their own, and then as part of a page reading all of
+the form's fields (where the page's own overhead is the same for both).
+"""
+import cgi, sys, time
+from StringIO import StringIO
+from urllib import urlencode
+from web_haiku import Page, parse_urlencoded
+
+FIELDS = dict(
+    name='Joe', animal='Dog', email='joe@dog.com',
+    comment='Dogs are the best animals of all!  ' * 3,
+)
+
+class Form(Page):
+    form_defaults = dict.fromkeys(FIELDS, '')
+
+class FieldStorageForm(Form):
+    def read_form(self):
+        # what Page.parse_form() used to do
+        self.form_data = cgi.FieldStorage(
+            self.environ['wsgi.input'], environ=self.environ
+        )
+        self.form_parsed = True
+
+def make_environ(body):
+    return {
+        'REQUEST_METHOD': 'POST', 'QUERY_STRING': '',
+        'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+        'CONTENT_LENGTH': str(len(body)), 'wsgi.input': StringIO(body),
+    }
+
+def field_storage(body):
+    environ = make_environ(body)
+    form = cgi.FieldStorage(environ['wsgi.input'], environ=environ)
+    return [form[k].value for k in FIELDS]
+
+def web_haiku(body):
+    environ = make_environ(body)
+    form = parse_urlencoded(environ['wsgi.input'].read(len(body)))
+    parse_urlencoded(environ['QUERY_STRING'], form)
+    return [form[k].value for k in FIELDS]
+
+def page_reading(cls):
+    def page(body):
+        page = type.__call__(cls, make_environ(body), None)
+        return [getattr(page, k) for k in FIELDS]
+    page.__name__ = cls.__name__
+    return page
+
+def per_call(func, body, repeat):
+    start = time.time()
+    for i in xrange(repeat):
+        func(body)
+    return (time.time() - start) / repeat
+
+def compare(title, funcs, body, repeat):
+    print title
+    results = [func(body) for func in funcs]
+    assert results == results[:1] * len(results)
+    for func in funcs:
+        print "  %-17s %8.2f usec/POST" % (
+            func.__name__, per_call(func, body, repeat) * 1e6
+        )
+
+def main(repeat=20000):
+    body = urlencode(FIELDS)
+    compare("Parsing only:", [field_storage, web_haiku], body, repeat)
+    compare(
+        "Page reading all fields:",
+        [page_reading(FieldStorageForm), page_reading(Form)], body, repeat
+    )
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,218 @@
+"""Time WebHaiku's hot paths, and compare the results with a saved baseline
+
+Run ``python -m benchmarks.suite [options] [scenario ...]`` from the source
+directory.  Use ``--save`` to write the results as JSON, and ``--baseline``
+to compare them with previously-saved results; the exit status is 1 if any
+scenario got slower than the baseline by more than ``--threshold`` percent.
+"""
+import sqlite3, sys, time
+from optparse import OptionParser
+from StringIO import StringIO
+from urllib import urlencode
+from wsgiref.util import setup_testing_defaults
+from web_haiku import Page, Text, HTML, DB, Dispatcher, TestContainer, TestForm
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+scenarios = []  # (name, setup) pairs; setup() returns a function to time
+options = None
+
+def scenario(func):
+    scenarios.append((func.__name__, func))
+    return func
+
+def start_response(status, headers, exc_info=None):
+    return lambda data: None
+
+def wsgi(app, path='/', method='GET', body=None, **extra):
+    """Return a function that runs a request through `app`"""
+    base = {}
+    setup_testing_defaults(base)
+    base.update(PATH_INFO=path, REQUEST_METHOD=method, **extra)
+    if body is not None:
+        base['CONTENT_LENGTH'] = str(len(body))
+    if options.dispatcher:
+        app = Dispatcher(app)
+    def run():
+        environ = base.copy()
+        if body is not None:
+            environ['wsgi.input'] = StringIO(body)
+        return ''.join(app(environ, start_response))
+    return run
+
+
+class Hello(Page):
+    greeting, name = 'Hello', 'world'
+    body = Text("$greeting, $name!  Welcome to $$WebHaiku.\n" * 5)
+
+class Expressions(Page):
+    items, title = range(20), 'item'
+    body = HTML(
+        '<ul>%s</ul>' % ''.join([
+            '<li>$(?title.title()?) $(?items[%d] + 1?) of $(?len(items)?)</li>'
+            % (i,) for i in range(20)
+        ])
+    )
+
+def nested(depth):
+    cls = Text.page("You found me!")
+    for level in range(depth):
+        cls = type(Page)('Level%d' % level, (Page,), dict(child=cls))
+    return cls
+
+class MemoryDB(DB):
+    def db_connect(self):
+        return sqlite3.connect(':memory:')
+
+
+@scenario
+def text_render():
+    return wsgi(Hello)
+
+@scenario
+def eval_render():
+    return wsgi(Expressions)
+
+@scenario
+def nested_dispatch():
+    return wsgi(nested(10), '/child' * 10)
+
+@scenario
+def not_found():
+    return wsgi(TestContainer, '/nowhere')
+
+@scenario
+def slash_redirect():
+    return wsgi(TestContainer, '/c')
+
+@scenario
+def head_static():
+    return wsgi(TestContainer, '/', 'HEAD')
+
+@scenario
+def head_dynamic():
+    return wsgi(TestForm, '/', 'HEAD')
+
+@scenario
+def form_post():
+    return wsgi(
+        TestForm, '/', 'POST',
+        urlencode(dict(name='Joe', animal='Dog', email='joe@dog.com')),
+        CONTENT_TYPE='application/x-www-form-urlencoded',
+    )
+
+@scenario
+def db_query():
+    db = MemoryDB()
+    db.cursor("CREATE TABLE items (id INTEGER, name TEXT, price REAL)")
+    db.executemany(
+        "INSERT INTO items VALUES (?, ?, ?)",
+        ((n, 'Item #%d' % n, n * 0.25) for n in xrange(options.rows))
+    )
+    def run():
+        for row in db.query("SELECT id, name, price FROM items"):
+            row.id, row.name, row.price
+    return run
+
+
+def measure(func, min_time, repeat):
+    """Return the best time (in seconds) per call of `func`, and #calls/run"""
+    count = 1
+    while True:     # find a number of calls that takes at least `min_time`
+        start = time.time()
+        for i in xrange(count):
+            func()
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            break
+        count *= elapsed and min(10, int(1.5 * min_time/elapsed) + 1) or 10
+    best = elapsed
+    for r in range(repeat - 1):
+        start = time.time()
+        for i in xrange(count):
+            func()
+        best = min(best, time.time() - start)
+    return best / count, count
+
+def run(names):
+    results = {}
+    for name, setup in scenarios:
+        if names and name not in names:
+            continue
+        per_call, count = measure(setup(), options.min_time, options.repeat)
+        results[name] = dict(usec=round(per_call * 1e6, 3), calls=count)
+    return dict(python=sys.version.split()[0], results=results)
+
+def changes(results, baseline):
+    """Return the percent change in time from `baseline` for each scenario"""
+    changed = {}
+    for name, result in results.items():
+        old = baseline.get(name, {}).get('usec')
+        if old:
+            changed[name] = round((result['usec'] - old) / old * 100, 2)
+    return changed
+
+def report(data, baseline, threshold):
+    """Print `data` as a table, with changes from `baseline` (if any)"""
+    for name, setup in scenarios:
+        if name not in data['results']:
+            continue
+        usec = data['results'][name]['usec']
+        if name not in data.get('changes', {}):
+            print "%-16s %12.2f usec" % (name, usec)
+            continue
+        change = data['changes'][name]
+        print "%-16s %12.2f usec  (baseline %.2f, %+.1f%%)%s" % (
+            name, usec, baseline[name]['usec'], change,
+            change > threshold and '  SLOWER' or ''
+        )
+
+def main(args=None):
+    global options
+    parser = OptionParser(usage="%prog [options] [scenario ...]")
+    parser.add_option("-s", "--save", metavar="FILE",
+        help="save the results as JSON to FILE")
+    parser.add_option("-b", "--baseline", metavar="FILE",
+        help="compare with saved results from FILE")
+    parser.add_option("-t", "--threshold", type="float", default=10.0,
+        help="percent slowdown that counts as a regression [%default]")
+    parser.add_option("-j", "--json", action="store_true",
+        help="print the results as JSON instead of a table")
+    parser.add_option("-d", "--dispatcher", action="store_true",
+        help="run requests through a Dispatcher")
+    parser.add_option("--min-time", type="float", default=0.2,
+        help="minimum seconds per timing run [%default]")
+    parser.add_option("--repeat", type="int", default=5,
+        help="timing runs per scenario (the best is used) [%default]")
+    parser.add_option("--rows", type="int", default=10000,
+        help="rows returned by db_query [%default]")
+    options, names = parser.parse_args(args)
+    unknown = [name for name in names if name not in dict(scenarios)]
+    if unknown:
+        parser.error("unknown scenario(s): %s" % ', '.join(unknown))
+
+    data = run(names)
+    baseline = {}
+    if options.baseline:
+        f = open(options.baseline)
+        baseline = json.load(f)['results']
+        f.close()
+        data['changes'] = changes(data['results'], baseline)
+    if options.save:
+        f = open(options.save, 'w')
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.close()
+    if options.json:
+        print json.dumps(data, indent=2, sort_keys=True)
+    else:
+        report(data, baseline, options.threshold)
+    for change in data.get('changes', {}).values():
+        if change > options.threshold:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
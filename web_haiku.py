@@ -1,11 +1,16 @@
 """Yet another WSGI micro-framework..."""
-import cgi, string, new, sys
+import string, sys, time, re, operator
+from types import GeneratorType, MethodType
 from wsgiref.util import shift_path_info, application_uri
 from peak import context
 
 __all__ = [
     "Page", "form_handler", "HTML", "Text", "Template", "HTTP", "expose",
-    "test", "Redirector", "EvalTemplate", "EvalMap", "Method", "DB"
+    "test", "Redirector", "EvalTemplate", "EvalMap", "Method", "DB",
+    "LRUCache", "Dispatcher", "Route", "ResponseCache", "FormData", "Field",
+    "RequestTooLarge", "BadRequest", "Invalid", "required", "length", "matches", "convert",
+    "ConnectionPool", "QueryCache", "Transaction", "Server", "warm_up",
+    "Client", "Stats", "StatsPage", "Profiler",
 ]
 
 class Method(object):
@@ -15,7 +20,7 @@ class Method(object):
 
     def __get__(self, ob, typ=None):
         if ob is None: return self
-        return new.instancemethod(self.call, ob, typ)
+        return MethodType(self.call, ob, typ)
 
 class HTTP(Method):
     """Wrapper/decorator that marks an object as an HTTP method"""
@@ -33,14 +38,172 @@ def form_handler(arg):
         return decorator(arg)
     return decorator
 
+class Invalid(Exception):
+    """A form field value failed validation"""
+
+def required(message="%(name)s is required"):
+    """Validator that rejects missing or blank values"""
+    def check(value):
+        if value is None or not value.strip():
+            raise Invalid(message)
+        return value
+    return check
+
+def length(min=0, max=None, message=None):
+    """Validator that rejects values outside the given length range"""
+    if message is None:
+        if max is None:
+            message = "%%(name)s must be at least %d characters" % min
+        else:
+            message = "%%(name)s must be %d to %d characters" % (min, max)
+    def check(value):
+        if value is not None and (
+            len(value) < min or max is not None and len(value) > max
+        ):
+            raise Invalid(message)
+        return value
+    return check
+
+def matches(pattern, message="%(name)s is not valid"):
+    """Validator that rejects values not matching a regular expression"""
+    match = re.compile('(?:%s)$' % pattern).match
+    def check(value):
+        if value is not None and match(value) is None:
+            raise Invalid(message)
+        return value
+    return check
+
+def convert(type, message="%(name)s is not valid"):
+    """Validator that converts a value, e.g. using ``int`` or ``float``"""
+    def check(value):
+        if value is not None:
+            try:
+                return type(value)
+            except (TypeError, ValueError):
+                raise Invalid(message)
+    return check
+
+def compile_validators(spec):
+    """Return a function that validates a page's form fields in one pass
+
+    `spec` is a sequence of ``(name, validator...)`` tuples, or a dictionary
+    mapping field names to lists of validators (applied in name order).
+    Missing fields are validated as None.  Valid values (other than None) are
+    stored as attributes of the page; errors are added to its ``errors``, with
+    any ``%(name)s`` in the message replaced by the field name.
+    """
+    if isinstance(spec, dict):
+        spec = [(name, tuple(spec[name])) for name in sorted(spec)]
+    else:
+        spec = [(item[0], item[1:]) for item in spec]
+
+    def validate_form(page):
+        form, errors, values = page.parse_form(), page.errors, page.__dict__
+        for name, validators in spec:
+            value = form.getfirst(name, None)
+            try:
+                for validator in validators:
+                    value = validator(value)
+            except Invalid, e:
+                message = e.args and str(e.args[0]) or "%(name)s is not valid"
+                errors.append(message.replace('%(name)s', name))
+            else:
+                if value is not None:
+                    values[name] = value
+    return validate_form
+
 text_plain = ('Content-Type', 'text/plain')
 text_html  = ('Content-Type', 'text/html')
 
+def escape(s, quote=None):
+    """Replace special characters with HTML entities (like ``cgi.escape``)"""
+    s = s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    if quote:
+        s = s.replace('"', "&quot;")
+    return s
+
+def etag_matches(environ, tag):
+    """Does the request's ``If-None-Match`` header match the ETag `tag`?"""
+    header = environ.get('HTTP_IF_NONE_MATCH', '').strip()
+    if header == '*':
+        return True
+    tags = [t.strip() for t in header.split(',')]
+    return tag in tags or 'W/'+tag in tags
+
+def md5_hex(data):
+    """Return the hex MD5 digest of `data`"""
+    try:
+        from hashlib import md5
+    except ImportError:     # Python 2.4
+        from md5 import md5
+    return md5(data).hexdigest()
+
+def parse_http_date(value):
+    """Return an HTTP date header's value as a timestamp (None if invalid)"""
+    from email.Utils import parsedate_tz, mktime_tz
+    try:
+        return mktime_tz(parsedate_tz(value))
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+def accept_encoding(environ, supported=('gzip', 'deflate')):
+    """Return the first of the `supported` codings the client likes best"""
+    header = environ.get('HTTP_ACCEPT_ENCODING')
+    if not header:
+        return None
+    accepted = {}
+    for item in header.split(','):
+        params = item.split(';')
+        quality = 1.0
+        for param in params[1:]:
+            param = param.strip()
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        accepted[params[0].strip().lower()] = quality
+    best, best_q = None, 0.0
+    for coding in supported:
+        quality = accepted.get(coding, accepted.get('*', 0.0))
+        if quality > best_q:
+            best, best_q = coding, quality
+    return best
+
+def compress(data, coding, level=6):
+    """Return `data` compressed with `coding` ('gzip' or 'deflate')"""
+    import zlib
+    if coding == 'deflate':
+        return zlib.compress(data, level)
+    from struct import pack
+    c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return ''.join([
+        '\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff',   # header, w/no mtime
+        c.compress(data), c.flush(),
+        pack('<LL', zlib.crc32(data) & 0xffffffffL, len(data) & 0xffffffffL)
+    ])
+
 def get_module():
     return sys._getframe(2).f_globals.get('__name__', __name__)
 
 sentinel = object()
 
+monitor = None  # object w/a ``record(kind, name, seconds)`` method, or None
+
+def timed(kind, name, func, *args, **kw):
+    """Call ``func(*args, **kw)``, recording its duration with the ``monitor``"""
+    m = monitor
+    if m is None:
+        return func(*args, **kw)
+    start = time.time()
+    try:
+        return func(*args, **kw)
+    finally:
+        m.record(kind, name, time.time() - start)
+
+def page_name(cls):
+    return '%s.%s' % (cls.__module__, cls.__name__)
+
 class EvalMap(object):
     """Object that translates from getitem->getattr"""
 
@@ -62,8 +225,7 @@ class EvalMap(object):
 
     def __getitem__(self, key):
         if key.startswith('(?') or '.' in key:
-            return eval(key.lstrip('(').rstrip(')').strip('?').strip(),
-                        sys.modules[self.module].__dict__, self)
+            return self.evaluate(expr_source(key))
         elif key in self.extra:
             return self.extra[key]
         else:
@@ -77,8 +239,194 @@ class EvalMap(object):
             return self
         raise KeyError(key)
 
+    def evaluate(self, expr):
+        """Evaluate `expr` (source or code object) in the page's namespace"""
+        return eval(expr, sys.modules[self.module].__dict__, self)
+
+def expr_source(key):
+    """Return the Python expression for a dotted or ``(? ... ?)`` key"""
+    return key.lstrip('(').rstrip(')').strip('?').strip()
+
 class EvalTemplate(string.Template):
     idpattern = r'[_a-z][_a-z0-9]*(?:\.[_a-z][_a-z0-9]*)*|\(\?[^?]*\?\)'
+    chunks = None
+
+    def compile(self):
+        """Return a list of ``(literal, key, code)`` chunks for the template
+
+        `key` is None for the trailing literal, and `code` is a compiled
+        expression for dotted or ``(? ... ?)`` keys (or None for plain names).
+        """
+        chunks, pos, text = [], 0, self.template
+        for mo in self.pattern.finditer(text):
+            literal = text[pos:mo.start()]
+            pos = mo.end()
+            key = mo.group('named') or mo.group('braced')
+            if key is not None:
+                code = None
+                if key.startswith('(?') or '.' in key:
+                    code = compile(expr_source(key), '<template>', 'eval')
+                chunks.append((literal, key, code))
+            elif mo.group('escaped') is not None:
+                chunks.append((literal + self.delimiter, None, None))
+            else:
+                self._invalid(mo)
+        chunks.append((text[pos:], None, None))
+        return chunks
+
+    def get_chunks(self):
+        """Return the template's compiled chunks, compiling them if needed"""
+        if self.chunks is None:
+            self.chunks = self.compile()
+        return self.chunks
+
+    def render(self, mapping):
+        """Same as ``substitute(mapping)``, but w/compiled chunks & code
+
+        `mapping` must be an ``EvalMap`` (or have a compatible ``evaluate()``
+        method).  The template is compiled on first use, and then reused.
+        """
+        if monitor is not None:
+            return self.render_timed(mapping, monitor)
+        out = []
+        for literal, key, code in self.get_chunks():
+            out.append(literal)
+            if code is not None:
+                out.append('%s' % (mapping.evaluate(code),))
+            elif key is not None:
+                out.append('%s' % (mapping[key],))
+        return ''.join(out)
+
+    def render_timed(self, mapping, monitor):
+        """Like ``render()``, but record the time taken by each placeholder"""
+        out, timer = [], time.time
+        for literal, key, code in self.get_chunks():
+            out.append(literal)
+            if key is not None:
+                start = timer()
+                if code is not None:
+                    out.append('%s' % (mapping.evaluate(code),))
+                else:
+                    out.append('%s' % (mapping[key],))
+                monitor.record('eval', key, timer() - start)
+        return ''.join(out)
+
+    def iterate(self, mapping):
+        """Like ``render()``, but yield the output a piece at a time
+
+        Placeholder values that are generators are iterated over, yielding
+        each of their items in turn.
+        """
+        for literal, key, code in self.get_chunks():
+            yield literal
+            if code is not None:
+                value = mapping.evaluate(code)
+            elif key is not None:
+                value = mapping[key]
+            else:
+                continue
+            if isinstance(value, GeneratorType):
+                for item in value:
+                    yield '%s' % (item,)
+            else:
+                yield '%s' % (value,)
+
+class LRUCache(object):
+    """Thread-safe, size-bounded LRU cache w/optional expiration
+
+    `max_size` is the total of ``sizeof(value)`` for all values stored (by
+    default, their ``len()``).  `ttl` is the default number of seconds a value
+    stays valid (None means forever).  The ``hits``, ``misses``, ``evictions``
+    and ``size`` attributes can be used to tune the cache's size.
+    """
+
+    hits = misses = evictions = size = 0
+
+    def __init__(self, max_size=1<<20, ttl=None, sizeof=len):
+        from threading import Lock
+        self.max_size, self.ttl, self.sizeof = max_size, ttl, sizeof
+        self.lock = Lock()
+        self.data = {}
+        root = self.root = []   # circular list of [prev, next, key, value,
+        root[:] = [root, root, None, None, None, 0]     # expires, size] links
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        """Return the cached value for `key`, or `default`"""
+        self.lock.acquire()
+        try:
+            link = self.data.get(key)
+            if link is not None:
+                if link[4] is not None and link[4] <= time.time():
+                    self.unlink(link)
+                else:
+                    root = self.root
+                    link[0][1], link[1][0] = link[1], link[0]   # move to front
+                    link[0], link[1] = root, root[1]
+                    root[1][0] = root[1] = link
+                    self.hits += 1
+                    return link[3]
+            self.misses += 1
+            return default
+        finally:
+            self.lock.release()
+
+    def set(self, key, value, ttl=None):
+        """Cache `value` under `key`, evicting old values if needed"""
+        size = self.sizeof(value)
+        if ttl is None:
+            ttl = self.ttl
+        expires = ttl is not None and time.time() + ttl or None
+        self.lock.acquire()
+        try:
+            if key in self.data:
+                self.unlink(self.data[key])
+            if size > self.max_size:
+                return
+            root = self.root
+            link = [root, root[1], key, value, expires, size]
+            root[1][0] = root[1] = self.data[key] = link
+            self.size += size
+            while self.size > self.max_size:
+                self.unlink(root[0])    # least-recently used
+                self.evictions += 1
+        finally:
+            self.lock.release()
+
+    def discard(self, key):
+        """Remove `key` from the cache, if present"""
+        self.lock.acquire()
+        try:
+            if key in self.data:
+                self.unlink(self.data[key])
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.data.clear()
+            root = self.root
+            root[:] = [root, root, None, None, None, 0]
+            self.size = 0
+        finally:
+            self.lock.release()
+
+    def unlink(self, link):
+        # caller must hold the lock
+        link[0][1], link[1][0] = link[1], link[0]
+        del self.data[link[2]]
+        self.size -= link[5]
+
+    def stats(self):
+        """Return a dictionary of usage counters"""
+        return dict(
+            hits=self.hits, misses=self.misses, evictions=self.evictions,
+            size=self.size, entries=len(self.data),
+        )
+
 
 class Text(Method):
     """Text template w/string substitution that can be used as a method
@@ -93,6 +441,19 @@ class Text(Method):
     status  = '200 OK'
     headers = text_plain,
     resource = caller = None
+    compiled = True     # use EvalTemplate.render() instead of substitute()
+    cache = cache_key = cache_ttl = None
+    cache_size = 1<<20
+    auto_etag = False   # send a content-hash ETag if the page has no etag()
+    compress = False    # gzip or deflate output if the client accepts it
+    compress_min = 512  # ...but not if it's shorter than this (and dynamic)
+    compress_level = 6
+    streaming = False   # send output as it's rendered, w/out Content-Length
+    chunk_size = 8192   # minimum size of streamed output blocks
+    name = None         # name used for timing stats (set by Page classes)
+    compiled_cache = None   # directory to save compiled `resource` templates in
+    check_mtime = False     # reload `resource` templates when their file changes
+    source = None       # (resource, mtime) of a loaded resource, w/check_mtime
 
     def __init__(self, *args, **kw):
         kw.setdefault('caller', get_module())
@@ -101,25 +462,187 @@ class Text(Method):
                 setattr(self, k, v)
                 del kw[k]
         if self.resource:
-            self.options = kw
+            from threading import Lock
+            self.options, self.loading = kw, Lock()
         else:
             self.template = self.factory(*args, **kw)
+        if self.cache_key is not None and self.cache is None:
+            self.cache = LRUCache(self.cache_size, self.cache_ttl)
 
     def call(self, page, extra_headers = [], **kw):
+        if self.streaming:
+            page.start_response(self.status, list(self.headers)+extra_headers)
+            return self.stream(page, kw)
         content = self.render(page, kw)
         headers = list(self.headers) + extra_headers
+        coding, vary = None, []
+        if self.compress:
+            vary = [('Vary', 'Accept-Encoding')]
+            headers.extend(vary)
+            if isinstance(content, str) and (
+                len(content) >= self.compress_min or self.is_static()
+            ):
+                coding = accept_encoding(page.environ)
+        if self.auto_etag and getattr(page, 'etag', None) is None:
+            tag = md5_hex(content)
+            tag = coding and '"%s-%s"' % (tag, coding) or '"%s"' % tag
+            if etag_matches(page.environ, tag):
+                page.start_response('304 Not Modified', [('ETag', tag)]+vary)
+                return []
+            headers.append(('ETag', tag))
+        if coding:
+            content = self.compressed(content, coding)
+            headers.append(('Content-Encoding', coding))
         headers.append(('Content-Length',str(len(content))))
         page.start_response(self.status, headers)
         return [content]
 
     def render(self, page, kw={}):
-        if self.resource:
-             from pkg_resources import resource_string
-             body = resource_string(self.caller, self.resource)
-             self.template = self.factory(body, **self.options)
-             self.resource = None
+        if monitor is not None:
+            return timed('render', self.name, self.render_cached, page, kw)
+        return self.render_cached(page, kw)
+
+    def render_cached(self, page, kw={}):
+        if self.source:
+            self.load()     # discard cached output if the resource changed
+        if self.cache_key is None:
+            return self.expand(page, kw)
+        key = self.output_key(page, kw)
+        content = self.cache.get(key, sentinel)
+        if content is sentinel:
+            content = self.expand(page, kw)
+            self.cache.set(key, content)
+        return content
+
+    def output_key(self, page, kw={}):
+        """Return the key for this template's cached output for `page`
+
+        The key includes the template's identity, so that templates can share
+        a ``cache``.
+        """
+        key = id(self), self.cache_key(page)
+        if kw:
+            key = key, tuple(sorted(kw.items()))
+        return key
+
+    def expand(self, page, kw={}):
+        """Render the template for `page` (bypassing any cache)"""
+        if self.resource or self.source:
+            self.load()
+        if self.is_compiled():
+            return self.template.render(EvalMap(page, kw, self.caller))
         return self.template.substitute(EvalMap(page, kw, self.caller))
 
+    def is_compiled(self):
+        """True if `compiled` is set and the template supports it
+
+        (Templates made by a custom ``factory`` that aren't ``EvalTemplate``
+        objects are rendered with ``substitute()`` instead.)
+        """
+        return self.compiled and hasattr(self.template, 'get_chunks')
+
+    def head(self, page, kw={}):
+        """Return ``(status, headers)`` for a HEAD, if the length is known
+
+        The length is known if the template has no placeholders, or if its
+        output for `page` is cached.  Otherwise, None is returned.
+        """
+        if self.streaming or self.compress or self.auto_etag:
+            return None
+        if self.source:
+            self.load()
+        if self.cache_key is not None:
+            content = self.cache.get(self.output_key(page, kw))
+            if content is not None:
+                return self.status, list(self.headers) + [
+                    ('Content-Length', str(len(content)))
+                ]
+        if not self.is_static():
+            return None
+        length = 0
+        for literal, key, code in self.template.get_chunks():
+            length += len(literal)
+        return self.status, list(self.headers)+[('Content-Length',str(length))]
+
+    def is_static(self):
+        """True if the template is compiled and has no placeholders"""
+        if self.resource or self.source:
+            self.load()
+        if not self.is_compiled():
+            return False
+        for literal, key, code in self.template.get_chunks():
+            if key is not None:
+                return False
+        return True
+
+    def compressed(self, content, coding):
+        """Return compressed `content`, reusing it if the template is static"""
+        if not self.is_static():
+            return compress(content, coding, self.compress_level)
+        precompressed = self.__dict__.setdefault('precompressed', {})
+        if coding not in precompressed:
+            precompressed[coding] = compress(content,coding,self.compress_level)
+        return precompressed[coding]
+
+    def stream(self, page, kw={}):
+        """Yield the rendered template in blocks of at least `chunk_size`"""
+        if self.resource or self.source:
+            self.load()
+        if hasattr(self.template, 'iterate'):
+            texts = self.template.iterate(EvalMap(page, kw, self.caller))
+        else:
+            texts = [self.expand(page, kw)]
+        buffer, size = [], 0
+        for text in texts:
+            buffer.append(text)
+            size += len(text)
+            if size >= self.chunk_size:
+                yield ''.join(buffer)
+                buffer, size = [], 0
+        if size:
+            yield ''.join(buffer)
+
+    def load(self):
+        """Load and parse the template's `resource` (only once, w/threads)
+
+        If ``check_mtime`` is set, the resource is loaded again whenever its
+        file's modification time changes.
+        """
+        self.loading.acquire()
+        try:
+            if self.resource:
+                self.load_resource(self.resource)
+            elif self.source:
+                resource, mtime = self.source
+                if resource_mtime(self.caller, resource) != mtime:
+                    self.load_resource(resource)
+        finally:
+            self.loading.release()
+
+    def load_resource(self, resource):
+        # caller must hold the lock
+        from pkg_resources import resource_string
+        if self.check_mtime:
+            self.source = resource, resource_mtime(self.caller, resource)
+        body = resource_string(self.caller, resource)
+        template = self.factory(body, **self.options)
+        if self.compiled and self.compiled_cache and hasattr(
+            template, 'get_chunks'
+        ):
+            load_compiled(template, self.compiled_cache, self.caller, resource)
+        self.template = template
+        self.resource = None
+        self.__dict__.pop('precompressed', None)
+        if self.cache is not None:
+            self.cache.clear()
+
+    def prepare(self):
+        """Load and compile the template now, instead of on first use"""
+        if self.resource or self.source:
+            self.load()
+        if self.is_compiled():
+            self.template.get_chunks()
+
 
     @classmethod
     def fragment(cls, *args, **kw):
@@ -162,6 +685,58 @@ class Text(Method):
 
 
 
+def resource_mtime(caller, resource):
+    """Return the modification time of a resource's file (or None)"""
+    import os
+    from pkg_resources import resource_filename
+    try:
+        return os.path.getmtime(resource_filename(caller, resource))
+    except (EnvironmentError, NotImplementedError):
+        return None
+
+compiled_format = 1     # change when the format of compiled chunks changes
+
+def load_compiled(template, directory, caller, resource):
+    """Set `template`'s chunks from (or save them to) a compiled cache file
+
+    The file is named for a hash of the cache format, the Python bytecode
+    version, the template class and syntax, and the resource's name and
+    contents, so a changed resource (or Python, or WebHaiku) gets a new file.
+    """
+    import os, imp, marshal
+    key = md5_hex('\0'.join([
+        str(compiled_format), imp.get_magic(), type(template).__name__,
+        template.pattern.pattern, caller, resource, template.template
+    ]))
+    path = os.path.join(directory, key + '.chunks')
+    try:
+        f = open(path, 'rb')
+        try:
+            template.chunks = marshal.load(f)
+            return
+        finally:
+            f.close()
+    except (EnvironmentError, EOFError, ValueError, TypeError):
+        pass
+    data = marshal.dumps(template.get_chunks())
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        from tempfile import mkstemp
+        fd, tmp = mkstemp(dir=directory)
+        try:
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+            os.rename(tmp, path)    # atomic, so readers never see partial files
+        except EnvironmentError:
+            os.remove(tmp)
+            raise
+    except EnvironmentError:
+        pass    # caching is only an optimization
+
+
 class HTML(Text):
     """HTML template w/string substitution that can be used as a method
 
@@ -180,27 +755,143 @@ class Template(HTML):
     Page's ``body`` attribute.
     """
 
-    engine = None
+    engine = None       # Buffet engine to use (default: shared by engine name)
+    pass_loaded = False # pass the loaded template to render(), not its name
     resource = property(lambda self:None)   # resources can't be used for this
 
     def factory(self, templatename, **options):
-        engine, name = templatename.split(':', 1)
-        from pkg_resources import iter_entry_points
-        for ep in iter_entry_points('python.templating.engines',engine):
-            self.engine = ep.load()()
-            break
-        else:
-            raise RuntimeError("Template engine %r is not installed" % (engine,))
+        self.engine_name, name = templatename.split(':', 1)
         return name
 
-    def render(self, page, kw={}):
-        return self.engine.render(
-            EvalMap(page,kw,self.caller), template=self.template
+    def get_engine(self):
+        return self.engine or get_engine(self.engine_name)
+
+    def load_template(self):
+        """Have the engine load (and compile) the template, and return it"""
+        load = getattr(self.get_engine(), 'load_template', None)
+        if load is not None:
+            return load(self.template)
+
+    def loaded_template(self):
+        """Return the engine's loaded template, shared by engine and name"""
+        key = self.engine or self.engine_name, self.template
+        try:
+            return loaded_templates[key]
+        except KeyError:
+            template = self.load_template() or self.template
+            return loaded_templates.setdefault(key, template)
+
+    def prepare(self):
+        if self.pass_loaded:
+            self.loaded_template()
+        else:
+            self.load_template()    # so the engine has it cached
+
+    def expand(self, page, kw={}):
+        template = self.template
+        if self.pass_loaded:
+            template = self.loaded_template()
+        return self.get_engine().render(
+            EvalMap(page,kw,self.caller), template=template
         )
 
+engines = {}            # engine name -> shared Buffet engine instance
+loaded_templates = {}   # (engine or name, template name) -> loaded template,
+                        # for templates with `pass_loaded` set
+
+def get_engine(name):
+    """Return the shared instance of the named Buffet template engine"""
+    try:
+        return engines[name]
+    except KeyError:
+        from pkg_resources import iter_entry_points
+        for ep in iter_entry_points('python.templating.engines', name):
+            return engines.setdefault(name, ep.load()())
+        raise RuntimeError("Template engine %r is not installed" % (name,))
+
+
+
+
+
+
+def template_of(ob):
+    """Return the ``Text`` used by `ob` (a template, fragment, or method)"""
+    if isinstance(ob, property):
+        ob = getattr(ob.fget, 'im_self', None)
+    elif isinstance(ob, Method) and not isinstance(ob, Text):
+        ob = getattr(ob.call, 'im_self', None)
+    if isinstance(ob, Text):
+        return ob
+
+
+route_types = {
+    # name: (regular expression, conversion function)
+    'str': (r'[^/]+', str),
+    'int': (r'\d+', int),
+}
 
+route_var = re.compile(r'<(?:(\w+):)?(\w+)>')
 
+class Route(object):
+    """A child page for path segments matching a pattern
 
+    Patterns may contain ``<name>`` or ``<type:name>`` variables, where
+    `type` is a key in ``route_types`` (``str`` by default).  The values are
+    passed to `page` as keyword arguments, so it must have attributes with
+    the same names.  Routes are tried in order of (`priority`, attr name).
+    """
+
+    cls_registry = "child_routes"
+
+    def __init__(self, pattern, page, priority=0):
+        self.pattern, self.page, self.priority = pattern, page, priority
+
+    def regex(self, prefix):
+        """Return a regex for the pattern, and a list of its captures
+
+        Each capture is a ``(name, group, convert)`` tuple.  Groups are
+        named by adding `prefix` to the variable name.
+        """
+        pos, regex, captures = 0, [], []
+        for m in route_var.finditer(self.pattern):
+            regex.append(re.escape(self.pattern[pos:m.start()]))
+            expr, convert = route_types[m.group(1) or 'str']
+            group = prefix + m.group(2)
+            regex.append('(?P<%s>%s)' % (group, expr))
+            captures.append((m.group(2), group, convert))
+            pos = m.end()
+        regex.append(re.escape(self.pattern[pos:]))
+        return ''.join(regex), captures
+
+def compile_routes(routes):
+    """Return a function that matches a path segment against `routes`
+
+    The function returns a ``(page, kw)`` tuple for the first matching route,
+    or None.  Routes are combined into as few regular expressions as the
+    ``re`` module's group limit allows (one, in the typical case).
+    """
+    matchers, parts, table, groups = [], [], {}, 0
+    for n, route in enumerate(routes):
+        group = 'r%d' % n
+        regex, captures = route.regex(group+'_')
+        if parts and groups + len(captures) >= 99:
+            matchers.append(re.compile('(?:%s)$' % '|'.join(parts)).match)
+            parts, groups = [], 0
+        parts.append('(?P<%s>%s)' % (group, regex))
+        groups += len(captures) + 1
+        table[group] = route.page, captures
+    if parts:
+        matchers.append(re.compile('(?:%s)$' % '|'.join(parts)).match)
+
+    def match_route(name):
+        for match in matchers:
+            m = match(name)
+            if m is not None:
+                page, captures = table[m.lastgroup]
+                return page, dict(
+                    [(k, convert(m.group(g))) for k, g, convert in captures]
+                )
+    return match_route
 
 
 def expose(func):
@@ -217,19 +908,61 @@ class Page(object):
     cls_registry = "sub_pages"
     http_methods = []
     sub_pages = []
+    child_routes = []
+    match_route = None
     body = None
 
     class __metaclass__(type):
         def __init__(cls, name, bases, cdict):
-            for k in dir(cls):
-                v = getattr(cls, k)
-                reg = getattr(v, 'cls_registry', None)
+            # Only names registered by our bases, or defined in this class,
+            # can be registered here (other bases get a full scan)
+            names = set(cdict)
+            for base in bases:
+                registered = getattr(base, '__registered__', None)
+                if registered is None:
+                    names.update(dir(base))
+                else:
+                    names.update(registered)
+            for k, v in cdict.items():
+                text = template_of(v)
+                if text is not None and text.name is None:
+                    text.name = '%s.%s' % (page_name(cls), k)
+            registered = cls.__registered__ = {}
+            for k in names:
+                reg = getattr(getattr(cls, k, None), 'cls_registry', None)
                 if reg:
-                    d = cdict.setdefault(reg,[])
-                    d.append(k)
-                    setattr(cls, reg, d)
+                    registered[k] = reg
+            for k in sorted(registered):
+                d = cdict.setdefault(registered[k], [])
+                d.append(k)
+                setattr(cls, registered[k], d)
+            if cdict.get('form_handlers'):
+                cls.form_handlers.sort(
+                    key=lambda k: getattr(getattr(cls,k), 'priority', (0,k))
+                )
+            if 'form_validators' in cdict:
+                cls.validate_form = cls.form_validators and staticmethod(
+                    compile_validators(cls.form_validators)
+                ) or None
+            if cdict.get('child_routes'):
+                routes = [(getattr(cls,k).priority, k) for k in cls.child_routes]
+                routes.sort()
+                cls.match_route = staticmethod(
+                    compile_routes([getattr(cls,k) for p, k in routes])
+                )
+
+        def __setattr__(cls, name, value):
+            # Register things added after creation, for later subclasses
+            type.__setattr__(cls, name, value)
+            reg = getattr(value, 'cls_registry', None)
+            if reg and '__registered__' in cls.__dict__:
+                cls.__registered__[name] = reg
 
         def __call__(cls, *args, **kw):
+            if monitor is not None:
+                return timed('page', page_name(cls),
+                    lambda: type.__call__(cls, *args, **kw).go()
+                )
             self = type.__call__(cls, *args, **kw)
             return self.go()
 
@@ -240,11 +973,30 @@ class Page(object):
         for k, v in kw.items():
             getattr(cls,k)  # AttributeError here means bad keyword arg
             setattr(self,k,v)
-        self.setup()    # perform any dynamic initialization
+        if monitor is not None:
+            timed('setup', page_name(cls), self.setup)
+        else:
+            self.setup()    # perform any dynamic initialization
+
 
 
+    def head_response(self):
+        """Return ``(status, headers)`` for a HEAD, or None to run the GET
+
+        By default, the ``body`` template's ``head()`` is used (if there's
+        no explicit GET method).  Override this if your page can compute its
+        response headers more cheaply than by rendering its body.
+        """
+        body = type(self).body
+        if isinstance(body, Text) and 'GET' not in self.http_methods:
+            return body.head(self)
 
     def HEAD(self):
+        response = self.head_response()
+        if response is not None:
+            self.start_response(*response)
+            return ['']
+
         def write(txt):
             sr.length += len(txt)
 
@@ -269,7 +1021,7 @@ class Page(object):
         self.environ['REQUEST_METHOD'] = 'GET'
 
         try:
-            resp = self.invoke_method()   # forward to 'GET'
+            resp = self.handle_method()   # forward to 'GET'
             if 'Content-Length' not in sr.headers:
                 for chunk in resp:
                     sr.length += len(chunk)
@@ -285,14 +1037,69 @@ class Page(object):
         finally:
             sr.args = exc_info = None  # clean up exc_info, if still present
 
+    etag = last_modified = None
+
+    def check_modified(self):
+        """Return a 304 response if the client's copy is current, else None
+
+        Calls the page's ``etag()`` (which should return a string) and/or
+        ``last_modified()`` (which should return a timestamp) methods, if
+        defined, and compares the results to the request's ``If-None-Match``
+        or ``If-Modified-Since`` headers.  If the client's copy is still
+        current, a ``304 Not Modified`` response is returned.  Otherwise,
+        ``start_response`` is wrapped to add ``ETag`` and ``Last-Modified``
+        headers to a successful response, and None is returned.
+        """
+        environ, headers = self.environ, []
+        tag = modified = None
+        if self.etag is not None:
+            tag = self.etag()
+            if tag is not None:
+                if not tag.startswith('"') and not tag.startswith('W/'):
+                    tag = '"%s"' % tag
+                headers.append(('ETag', tag))
+        if self.last_modified is not None:
+            modified = self.last_modified()
+            if modified is not None:
+                from wsgiref.handlers import format_date_time
+                modified = int(modified)
+                headers.append(('Last-Modified', format_date_time(modified)))
+
+        if 'HTTP_IF_NONE_MATCH' in environ:
+            current = tag is not None and etag_matches(environ, tag)
+        elif 'HTTP_IF_MODIFIED_SINCE' in environ and modified is not None:
+            since = parse_http_date(environ['HTTP_IF_MODIFIED_SINCE'])
+            current = since is not None and modified <= since
+        else:
+            current = False
+
+        if current:
+            self.start_response('304 Not Modified', headers)
+            return []
+        elif headers:
+            start_response = self.start_response
+            def add_validators(status, response_headers, exc_info=None):
+                if status.startswith('2'):
+                    response_headers = list(response_headers) + headers
+                return start_response(status, response_headers, exc_info)
+            self.start_response = add_validators
+
     def go(self):
         self.URL = application_uri(self.environ)
         name = shift_path_info(self.environ)
         if name:
             return self.handle_child(name)
+        return self.handle_self(name)
+
+    def handle_self(self, name):
+        """Invoke this page, or redirect to add/remove its trailing ``/``
 
+        `name` is ``''`` if the URL had a trailing ``/``, or None if not.
+        """
         url = self.URL.rstrip('/')
-        leaf = not self.sub_pages and type(self).handle_child == Page.handle_child
+        leaf = not (self.sub_pages or self.child_routes) and (
+            type(self).handle_child == Page.handle_child
+        )
 
         if name=='':    # trailing /
             if not leaf or self.environ.get('SCRIPT_NAME')=='/':
@@ -311,6 +1118,13 @@ class Page(object):
             return getattr(self, name)(
                 self.environ, self.start_response, parent=self
             )
+        if self.match_route is not None:
+            found = self.match_route(name)
+            if found is not None:
+                page, kw = found
+                return page(
+                    self.environ, self.start_response, parent=self, **kw
+                )
         return self.NOT_FOUND()
 
     def redirect(self, url):
@@ -326,13 +1140,40 @@ class Page(object):
 
 
 
+    response_ttl = None     # seconds a ResponseCache may keep our response
+    response_vary = ()      # request headers the response depends on
+
     def invoke_method(self):
+        rm = self.environ['REQUEST_METHOD']
+        if self.response_ttl is not None:
+            self.environ['web_haiku.response_cache'] = (
+                self.response_ttl, self.response_vary
+            )
+        if (rm=='GET' or rm=='HEAD') and (
+            self.etag is not None or self.last_modified is not None
+        ):
+            response = self.check_modified()
+            if response is not None:
+                return response
+        try:
+            if monitor is not None:
+                return timed('method', '%s.%s' % (page_name(type(self)), rm),
+                    self.handle_method
+                )
+            return self.handle_method()
+        except RequestTooLarge:
+            return self.REQUEST_TOO_LARGE()
+        except BadRequest:
+            return self.BAD_REQUEST()
+
+    def handle_method(self):
+        """Invoke the method (or body) for the current request method"""
         rm = self.environ['REQUEST_METHOD']
         if rm=='HEAD' or rm in self.http_methods:
             return getattr(self, rm)()
         elif rm=='GET' and self.body is not None:
             return self.body()
-        elif rm=='POST' and self.form_handlers:
+        elif rm=='POST' and (self.form_handlers or self.validate_form):
             return self.POST()
 
         methods = set(self.http_methods)    # Compute available methods
@@ -340,7 +1181,7 @@ class Page(object):
             methods.add('GET')
         if 'GET' in methods:
             methods.add('HEAD')
-        if self.form_handlers:
+        if self.form_handlers or self.validate_form:
             methods.add('POST')
 
         return self.METHOD_NOT_ALLOWED([('Allow', ', '.join(sorted(methods)))])
@@ -366,37 +1207,102 @@ class Page(object):
         status  = '404 Not Found',
     )
 
+    REQUEST_TOO_LARGE = Text(
+        "Your gift is too large\n"
+        "My small arms cannot hold it\n"
+        "Please send something less\n",
+        status  = '413 Request Entity Too Large',
+    )
+
+    BAD_REQUEST = Text(
+        "Your words reached me torn\n"
+        "Half a form is not a form\n"
+        "Please send it again\n",
+        status  = '400 Bad Request',
+    )
+
 
     form_handlers = []
     form_parsed = False
     form_data = ()
     form_defaults = {}
-    escape = staticmethod(cgi.escape)
+    form_max_size = None        # largest request body allowed, in bytes
+    form_spool_size = 64<<10    # spool larger multipart values to disk
+    escape = staticmethod(escape)
+
+    form_validators = ()     # (name, validator...) tuples; see README
+    validate_form = None
 
     def get_handlers(self):
-        handlers = [getattr(self,k) for k in self.form_handlers]
-        handlers.sort(key=lambda h: h.priority)
-        return handlers
+        # form_handlers is kept sorted by priority when the class is created
+        return [getattr(self,k) for k in self.form_handlers]
 
     def __getattr__(self, name):
         """Dynamic attributes from form_data and defaults"""
         if name in self.form_defaults:  # form vars must be explicitly listed
+            if not self.form_parsed:
+                self.parse_form()
             if name in self.form_data:
                 return self.form_data[name].value
             return self.form_defaults[name]
         raise AttributeError(name)
 
     def parse_form(self):
-        """Ensure that self.form_data contains a FieldStorage, and return it"""
+        """Ensure that self.form_data contains the parsed form, and return it
+
+        The query string (plus, for requests other than GET and HEAD, any
+        urlencoded or ``multipart/form-data`` body) is parsed into a
+        ``FormData``.  Other kinds of bodies go to a ``cgi.FieldStorage``.
+        ``RequestTooLarge`` is raised (before reading any input) if the
+        request's ``CONTENT_LENGTH`` exceeds ``form_max_size``, and
+        ``BadRequest`` if the body is malformed or incomplete.
+        """
         if not self.form_parsed:
-            self.form_data = cgi.FieldStorage(
-                self.environ['wsgi.input'], environ=self.environ
-            )
-            self.form_parsed = True
+            if monitor is not None:
+                timed('form', page_name(type(self)), self.read_form)
+            else:
+                self.read_form()
         return self.form_data
 
+    def read_form(self):
+        """Parse the request's form into self.form_data (see parse_form())"""
+        environ = self.environ
+        query = environ.get('QUERY_STRING', '')
+        if environ['REQUEST_METHOD'] in ('GET', 'HEAD'):
+            self.form_data = parse_urlencoded(query)
+        else:
+            try:
+                size = int(environ.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                raise BadRequest("Invalid Content-Length")
+            if self.form_max_size is not None and size > self.form_max_size:
+                raise RequestTooLarge(size)
+            ctype, params = parse_header(environ.get('CONTENT_TYPE', ''))
+            if ctype in ('application/x-www-form-urlencoded', ''):
+                self.form_data = parse_urlencoded(
+                    environ['wsgi.input'].read(size)
+                )
+                parse_urlencoded(query, self.form_data)
+            elif ctype=='multipart/form-data' and 'boundary' in params:
+                try:
+                    self.form_data = parse_multipart(
+                        environ['wsgi.input'], params['boundary'], size,
+                        self.form_spool_size
+                    )
+                except ValueError, e:
+                    raise BadRequest(str(e))
+                parse_urlencoded(query, self.form_data)
+            else:
+                import cgi
+                self.form_data = cgi.FieldStorage(
+                    environ['wsgi.input'], environ=environ
+                )
+        self.form_parsed = True
+
     def POST(self):
         self.parse_form()
+        if self.validate_form is not None:
+            self.validate_form(self)
         for handler in self.get_handlers():
             response = handler()
             if response:
@@ -449,18 +1355,1411 @@ class Page(object):
 
 
 
+class RequestTooLarge(Exception):
+    """The request body is larger than the page allows"""
+
+class BadRequest(Exception):
+    """The request body is malformed or incomplete"""
+
+
+def parse_header(line):
+    """Parse a header like ``cgi.parse_header()``: return (value, params)
+
+    The value and parameter names are lowercased.
+    """
+    parts = line.split(';')
+    params = {}
+    for part in parts[1:]:
+        if '=' in part:
+            k, v = part.split('=', 1)
+            v = v.strip()
+            if len(v)>=2 and v[0]==v[-1]=='"':
+                v = v[1:-1].replace('\\\\', '\\').replace('\\"', '"')
+            params[k.strip().lower()] = v
+    return parts[0].strip().lower(), params
+
+
+class Field(object):
+    """A form field's ``value`` and ``file``, plus its ``filename``, etc.
+
+    Fields whose value was spooled to disk have a temporary ``file``, and
+    their ``value`` is only read from it if requested.  Fields kept in memory
+    have a ``value``, and their ``file`` is a ``StringIO`` of it.
+    """
+
+    filename = type = None
+
+    def __init__(self, name, value=None, file=None, filename=None, type=None,
+        headers=()
+    ):
+        self.name, self.filename, self.type = name, filename, type
+        self.headers = headers
+        if value is not None:
+            self.value = value
+        if file is not None:
+            self.file = file
+
+    def __getattr__(self, name):
+        if name=='value':
+            self.file.seek(0)
+            return self.file.read()
+        elif name=='file':
+            from StringIO import StringIO
+            self.file = StringIO(self.value)
+            return self.file
+        raise AttributeError(name)
+
+    def __repr__(self):
+        return 'Field(%r, filename=%r)' % (self.name, self.filename)
+
+
+class FormData(object):
+    """Mapping from field names to (the first of) their ``Field`` objects"""
+
+    def __init__(self):
+        self.fields = {}
+        self.names = []
+
+    def add(self, field):
+        if field.name not in self.fields:
+            self.fields[field.name] = []
+            self.names.append(field.name)
+        self.fields[field.name].append(field)
+
+    def __contains__(self, name):
+        return name in self.fields
+
+    has_key = __contains__
+
+    def __getitem__(self, name):
+        return self.fields[name][0]
+
+    def __len__(self):
+        return len(self.names)
+
+    def keys(self):
+        return self.names[:]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def getvalue(self, name, default=None):
+        """Like ``cgi.FieldStorage.getvalue()``: value, list, or `default`"""
+        fields = self.fields.get(name)
+        if not fields:
+            return default
+        elif len(fields)==1:
+            return fields[0].value
+        return [f.value for f in fields]
+
+    def getall(self, name):
+        """Return a list of all the ``Field`` objects for `name`"""
+        return self.fields.get(name, [])[:]
+
+    def getfirst(self, name, default=None):
+        """Return the value of the first field named `name`, or `default`"""
+        if name in self.fields:
+            return self.fields[name][0].value
+        return default
+
+    def getlist(self, name):
+        """Return a list of the values of fields named `name`"""
+        return [f.value for f in self.fields.get(name, ())]
+
+
+def parse_urlencoded(data, form=None):
+    """Add fields from urlencoded `data` to `form` (a new FormData by default)
+
+    Like ``cgi.FieldStorage``, fields with blank values are ignored.
+    """
+    if form is None:
+        form = FormData()
+    for pair in data.replace(';', '&').split('&'):
+        if '=' not in pair:
+            continue
+        name, value = pair.split('=', 1)
+        if value:
+            name, value = name.replace('+', ' '), value.replace('+', ' ')
+            if '%' in name or '%' in value:
+                from urllib import unquote
+                name, value = unquote(name), unquote(value)
+            form.add(Field(name, value))
+    return form
+
+
+class Spool(object):
+    """Accumulate data in memory, moving it to a temporary file if large"""
+
+    file = None
+
+    def __init__(self, limit):
+        self.limit, self.size, self.data = limit, 0, []
+
+    def write(self, data):
+        self.size += len(data)
+        if self.file is not None:
+            self.file.write(data)
+        elif self.size > self.limit:
+            from tempfile import TemporaryFile
+            self.file = TemporaryFile('w+b')
+            self.file.write(''.join(self.data))
+            self.file.write(data)
+            self.data = None
+        else:
+            self.data.append(data)
+
+    def field(self, name, **kw):
+        if self.file is None:
+            return Field(name, ''.join(self.data), **kw)
+        self.file.seek(0)
+        return Field(name, file=self.file, **kw)
+
+
+def parse_multipart(stream, boundary, length, spool_size=64<<10,
+    block_size=8192, max_header_size=16<<10
+):
+    """Parse `length` bytes of ``multipart/form-data`` from `stream`
+
+    Input is read in blocks of at most `block_size` bytes, and parts larger
+    than `spool_size` are written to temporary files instead of being kept
+    in memory.  Returns a ``FormData``; raises ValueError for bad input.
+    """
+    form = FormData()
+    delimiter = '\r\n--' + boundary
+    keep = len(delimiter) + 1   # enough to hold a partial delimiter + "--"
+    buffer = ['\r\n']      # so that the first delimiter also matches
+    remaining = [length]
+
+    def read():
+        if remaining[0] <= 0:
+            raise ValueError("Incomplete multipart form data")
+        data = stream.read(min(block_size, remaining[0]))
+        if not data:
+            raise ValueError("Incomplete multipart form data")
+        remaining[0] -= len(data)
+        buffer[0] += data
+
+    def find(sep, sink=None):
+        # Discard (or write to `sink`) data up to `sep`, and return the rest
+        while True:
+            i = buffer[0].find(sep)
+            if i>=0:
+                if sink is not None:
+                    sink.write(buffer[0][:i])
+                buffer[0] = buffer[0][i+len(sep):]
+                return
+            elif len(buffer[0]) > keep:
+                if sink is not None:
+                    sink.write(buffer[0][:-keep])
+                buffer[0] = buffer[0][-keep:]
+            read()
+
+    find(delimiter)     # skip the preamble
+    while True:
+        while len(buffer[0]) < 2:
+            read()
+        if buffer[0].startswith('--'):
+            return form     # closing delimiter; ignore the epilogue
+        find('\r\n')       # (and any whitespace after the delimiter)
+
+        while not buffer[0].startswith('\r\n') and '\r\n\r\n' not in buffer[0]:
+            if len(buffer[0]) > max_header_size:
+                raise ValueError("Multipart headers too long")
+            read()
+        if buffer[0].startswith('\r\n'):
+            lines, buffer[0] = [], buffer[0][2:]
+        else:
+            head, buffer[0] = buffer[0].split('\r\n\r\n', 1)
+            lines = head.split('\r\n')
+
+        headers = []
+        for line in lines:
+            if ':' in line:
+                k, v = line.split(':', 1)
+                headers.append((k.strip().lower(), v.strip()))
+        headers = dict(headers)
+        disposition, params = parse_header(
+            headers.get('content-disposition', '')
+        )
+        spool = Spool(spool_size)
+        find(delimiter, spool)
+        if 'name' in params:
+            form.add(spool.field(
+                params['name'], filename=params.get('filename'),
+                type=headers.get('content-type'), headers=headers
+            ))
+
+
+class Dispatcher(object):
+    """WSGI app that routes requests through a Page tree w/precomputed tables
+
+    Calling a ``Dispatcher(root)`` is equivalent to calling `root` directly,
+    except that pages which don't override ``go()`` or ``handle_child()``
+    are traversed in a single loop, using a table of each class' child names
+    (built the first time the class is visited) instead of recursive
+    ``go()``/``handle_child()`` calls and ``sub_pages`` list scans.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.tables = {}
+
+    def table(self, cls):
+        """Return the set of `cls`' child names, or None if it's dynamic"""
+        try:
+            return self.tables[cls]
+        except KeyError:
+            if (cls.go.im_func is Page.go.im_func and
+                cls.handle_child.im_func is Page.handle_child.im_func
+            ):
+                table = frozenset(cls.sub_pages)
+            else:
+                table = None
+            self.tables[cls] = table
+            return table
+
+    def __call__(self, environ, start_response):
+        if monitor is not None:
+            return timed('page', page_name(self.root),
+                self.dispatch, environ, start_response
+            )
+        return self.dispatch(environ, start_response)
+
+    def dispatch(self, environ, start_response):
+        cls, kw = self.root, {}
+        while True:
+            page = type.__call__(cls, environ, start_response, **kw)
+            table = self.table(cls)
+            if table is None:
+                return page.go()
+            page.URL = application_uri(environ)
+            name = shift_path_info(environ)
+            if not name:
+                return page.handle_self(name)
+            elif name in table:
+                child, kw = getattr(page, name), {}
+            else:
+                found = cls.match_route is not None and cls.match_route(name)
+                if not found:
+                    return page.NOT_FOUND()
+                child, kw = found
+            kw['parent'] = page
+            if not (isinstance(child, type) and issubclass(child, Page)):
+                return child(environ, start_response, **kw)
+            cls = child
+
+
+def warm_up(root, dispatcher=None):
+    """Load and compile the templates of a Page tree ahead of its first use
+
+    `root` and every Page class reachable from it via its ``sub_pages`` and
+    ``child_routes`` are visited, and each ``Text`` template they hold (as an
+    attribute, fragment, or method) is prepared.  If a ``Dispatcher`` is
+    given, its tables are also filled in.  Returns the classes visited.
+    """
+    todo, seen = [root], {}
+    while todo:
+        cls = todo.pop()
+        if cls in seen:
+            continue
+        seen[cls] = True
+        if dispatcher is not None:
+            dispatcher.table(cls)
+        for base in cls.__mro__[:-1]:
+            for ob in base.__dict__.values():
+                if isinstance(ob, Route):
+                    ob = ob.page
+                text = template_of(ob)
+                if text is not None:
+                    text.prepare()
+                elif isinstance(ob, type) and issubclass(ob, Page):
+                    todo.append(ob)
+    return list(seen)
+
+
+class Stats(object):
+    """Thread-safe ``monitor`` that aggregates timings by kind and name
+
+    For each ``(kind, name)`` pair, it keeps a count of calls, their total
+    and maximum time, and a histogram counting the calls that took less than
+    each of the ``limits`` (in seconds), plus those that took longer.
+    """
+
+    limits = (.0001, .001, .01, .1, 1)
+
+    def __init__(self):
+        from threading import Lock
+        self.lock = Lock()
+        self.data = {}
+
+    def record(self, kind, name, seconds):
+        slot = 0
+        for limit in self.limits:
+            if seconds < limit:
+                break
+            slot += 1
+        self.lock.acquire()
+        try:
+            entry = self.data.get((kind, name))
+            if entry is None:
+                entry = self.data[kind, name] = [
+                    0, 0.0, 0.0, [0] * (len(self.limits) + 1)
+                ]
+            entry[0] += 1
+            entry[1] += seconds
+            if seconds > entry[2]:
+                entry[2] = seconds
+            entry[3][slot] += 1
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        """Return ``{kind: {name: stats}}``, where `stats` is a dictionary
+
+        Each `stats` dictionary has a ``count``, ``total``, ``mean``, ``max``,
+        and ``histogram`` (a list of counts, one per ``limits`` entry plus
+        one for calls that exceeded the highest limit).
+        """
+        self.lock.acquire()
+        try:
+            items = [(key, entry[:3]+[entry[3][:]]) for key, entry in
+                self.data.items()]
+        finally:
+            self.lock.release()
+        result = {}
+        for (kind, name), (count, total, max, histogram) in items:
+            result.setdefault(kind, {})[name] = dict(
+                count=count, total=total, mean=total/count, max=max,
+                histogram=histogram,
+            )
+        return result
+
+    def report(self):
+        """Return a text table of the stats, sorted by total time (in ms)"""
+        rows = []
+        for kind, names in self.snapshot().items():
+            for name, stats in names.items():
+                rows.append((stats['total'], kind, name, stats))
+        rows.sort()
+        rows.reverse()
+        heading = ['<%gms' % (limit*1000) for limit in self.limits]
+        heading.append('>=%gms' % (self.limits[-1]*1000))
+        lines = ["%-8s %8s %10s %10s %10s  %s  %s" % (
+            'kind', 'count', 'total', 'mean', 'max', ' '.join(heading), 'name'
+        )]
+        for total, kind, name, stats in rows:
+            lines.append("%-8s %8d %10.3f %10.3f %10.3f  %s  %s" % (
+                kind, stats['count'], total*1000, stats['mean']*1000,
+                stats['max']*1000, ' '.join([
+                    '%*d' % (len(h), n)
+                    for h, n in zip(heading, stats['histogram'])
+                ]), name
+            ))
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.data.clear()
+        finally:
+            self.lock.release()
+
+
+class StatsPage(Page):
+    """Page showing the ``monitor``'s statistics (if it's a ``Stats``)"""
+
+    def body(self):
+        self.start_response("200 OK", [text_plain])
+        if not isinstance(monitor, Stats):
+            return ["Statistics are not being collected.\n"]
+        return [monitor.report()]
+
+
+class Profiler(object):
+    """WSGI middleware that profiles slow or flagged requests to disk
+
+    A request is run under ``cProfile`` if its environment has a true value
+    for `environ_key` (by default, an ``X-Profile`` HTTP header), if it's
+    randomly `sample`-d (a fraction from 0 to 1), or if it's one of the next
+    `repeat` requests for a ``PATH_INFO`` whose last request took longer than
+    `threshold` seconds (until its response was closed).  The profiles of
+    flagged requests, and of any others that still take longer than
+    `threshold`, are saved in `directory`, which is used as a ring of at most
+    `keep` profiles.
+
+    While any request is being profiled, the profiler is the ``monitor``
+    (passing timings on to the previous monitor, if any).
+    """
+
+    saved = 0
+    active = 0      # number of requests being profiled
+    monitor = None  # the monitor to restore when no requests are profiled
+
+    def __init__(self, app, directory, threshold=1.0,
+        environ_key='HTTP_X_PROFILE', sample=0.0, repeat=3, keep=50
+    ):
+        from threading import Lock, local
+        self.app, self.directory, self.threshold = app, directory, threshold
+        self.environ_key, self.sample, self.repeat = environ_key, sample, repeat
+        self.keep = keep
+        self.lock = Lock()
+        self.local = local()
+        self.hot = {}   # PATH_INFO -> number of requests left to profile
+        self.slot = self.next_slot()
+
+    def record(self, kind, name, seconds):
+        timings = getattr(self.local, 'timings', None)
+        if timings is not None:
+            count, total = timings.get((kind, name), (0, 0.0))
+            timings[kind, name] = count+1, total+seconds
+        if self.monitor is not None:
+            self.monitor.record(kind, name, seconds)
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        reason = environ.get(self.environ_key) and 'flagged' or None
+        if reason is None and self.sample:
+            from random import random
+            if random() < self.sample:
+                reason = 'sampled'
+        if reason is None and path in self.hot:
+            self.lock.acquire()
+            try:
+                if self.hot.get(path):
+                    self.hot[path] -= 1
+                    reason = 'slow'
+                if not self.hot.get(path, 1):
+                    del self.hot[path]
+            finally:
+                self.lock.release()
+        if reason is not None:
+            return self.profile(environ, start_response, path, reason)
+
+        start = time.time()
+        def closed():
+            if time.time() - start > self.threshold:
+                self.lock.acquire()
+                try:
+                    self.hot[path] = self.repeat
+                finally:
+                    self.lock.release()
+        return ClosingIterator(self.app(environ, start_response), closed)
+
+    def profile(self, environ, start_response, path, reason):
+        try:
+            from cProfile import Profile
+        except ImportError:     # Python 2.4
+            from profile import Profile
+        def run():
+            result = self.app(environ, start_response)
+            try:
+                return list(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        profile, self.local.timings = Profile(), {}
+        self.start()
+        start = time.time()
+        try:
+            return profile.runcall(run)
+        finally:
+            elapsed = time.time() - start
+            self.stop()
+            timings, self.local.timings = self.local.timings, None
+            if reason=='flagged' or elapsed > self.threshold:
+                self.save(profile, environ, path, reason, elapsed, timings)
+
+    def start(self):
+        """Become the ``monitor`` (if not already) while profiling a request"""
+        global monitor
+        self.lock.acquire()
+        try:
+            if not self.active:
+                self.monitor, monitor = monitor, self
+            self.active += 1
+        finally:
+            self.lock.release()
+
+    def stop(self):
+        """Restore the previous ``monitor`` when no requests are profiled"""
+        global monitor
+        self.lock.acquire()
+        try:
+            self.active -= 1
+            if not self.active and monitor is self:
+                monitor = self.monitor
+        finally:
+            self.lock.release()
+
+    def save(self, profile, environ, path, reason, elapsed, timings):
+        """Write ``NNN.prof`` (for ``pstats``) and ``NNN.txt`` summary files"""
+        import os, pstats
+        self.lock.acquire()
+        try:
+            slot, self.slot = self.slot, (self.slot + 1) % self.keep
+            self.saved += 1
+        finally:
+            self.lock.release()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        base = os.path.join(self.directory, '%03d' % slot)
+        profile.dump_stats(base + '.prof')
+
+        pages = [name for (kind, name) in timings if kind=='method']
+        f = open(base + '.txt', 'w')
+        try:
+            print >>f, "PATH_INFO: %s" % path
+            print >>f, "QUERY_STRING: %s" % environ.get('QUERY_STRING', '')
+            print >>f, "Page: %s" % ', '.join(pages)
+            print >>f, "Elapsed: %.3fs (%s)" % (elapsed, reason)
+            print >>f, "Time: %s" % time.strftime('%Y-%m-%d %H:%M:%S')
+            print >>f
+            print >>f, "%-8s %8s %10s  name" % ('kind', 'count', 'total ms')
+            items = [(total, kind, count, name)
+                for (kind, name), (count, total) in timings.items()]
+            items.sort()
+            items.reverse()
+            for total, kind, count, name in items:
+                print >>f, "%-8s %8d %10.3f  %s" % (kind,count,total*1000,name)
+            print >>f
+            stats = pstats.Stats(base + '.prof', stream=f)
+            stats.sort_stats('cumulative').print_stats(30)
+        finally:
+            f.close()
+
+    def next_slot(self):
+        """Return the slot after the most recently saved profile (if any)"""
+        import os
+        if not os.path.isdir(self.directory):
+            return 0
+        saved = [(os.path.getmtime(os.path.join(self.directory, name)), name)
+            for name in os.listdir(self.directory) if name.endswith('.txt')]
+        if not saved:
+            return 0
+        try:
+            return (int(max(saved)[1][:-4]) + 1) % self.keep
+        except ValueError:
+            return 0
+
+    def profiles(self):
+        """Return the paths of the saved ``.txt`` summaries, newest first"""
+        import os
+        if not os.path.isdir(self.directory):
+            return []
+        saved = [os.path.join(self.directory, name)
+            for name in os.listdir(self.directory) if name.endswith('.txt')]
+        saved = [(os.path.getmtime(path), path) for path in saved]
+        saved.sort()
+        saved.reverse()
+        return [path for mtime, path in saved]
+
+
+class ResponseCache(object):
+    """WSGI middleware that caches complete GET responses from a Page tree
+
+    Only successful responses from pages with a ``response_ttl`` are cached,
+    and only if they don't set cookies.  Cached responses are keyed by URL
+    (i.e. ``SCRIPT_NAME``, ``PATH_INFO``, and ``QUERY_STRING``) plus the
+    values of the request headers named by the page's ``response_vary`` and
+    the response's ``Vary`` header.  Cached GET responses are also used to
+    answer HEAD requests.  All other requests are passed through unchanged.
+    """
+
+    def __init__(self, app, max_size=16<<20):
+        self.app = app
+        self.cache = LRUCache(max_size, sizeof=lambda entry: len(entry[2]))
+        self.vary = {}  # url -> environ keys that responses depend on
+
+    def stats(self):
+        """Return a dictionary of usage counters (w/``size`` in bytes)"""
+        return self.cache.stats()
+
+    def __call__(self, environ, start_response):
+        method = environ['REQUEST_METHOD']
+        if method!='GET' and method!='HEAD':
+            return self.app(environ, start_response)
+
+        url = (environ.get('SCRIPT_NAME', ''), environ.get('PATH_INFO', ''),
+            environ.get('QUERY_STRING', ''))
+        key = url + tuple([environ.get(k) for k in self.vary.get(url, ())])
+        entry = self.cache.get(key)
+        if entry is not None:
+            status, headers, body = entry
+            for name, value in headers:
+                if name.lower()=='etag' and etag_matches(environ, value):
+                    start_response('304 Not Modified', [(name, value)])
+                    return []
+            start_response(status, list(headers))
+            if method=='HEAD':
+                return ['']
+            return [body]
+        elif method=='HEAD':
+            return self.app(environ, start_response)
+
+        response, body = [], []
+        def capture(status, headers, exc_info=None):
+            response[:] = status, headers
+            write = start_response(status, headers, exc_info)
+            def write_through(data):
+                body.append(data)
+                write(data)
+            return write_through
+        return CollectingIterator(
+            self.app(environ, capture), body,
+            lambda: self.store(url, environ, response, body)
+        )
+
+    def store(self, url, environ, response, body):
+        """Cache a completely-sent response, if its page allows it"""
+        policy = environ.get('web_haiku.response_cache')
+        if policy is None or not response or response[0][:3]!='200':
+            return
+        ttl, vary = policy
+        vary = list(vary)
+        for name, value in response[1]:
+            name = name.lower()
+            if name=='set-cookie':
+                return
+            elif name=='vary':
+                vary.extend(value.split(','))
+        vary = dict.fromkeys(
+            ['HTTP_'+v.strip().upper().replace('-','_') for v in vary]
+        ).keys()
+        vary.sort()
+        self.vary[url] = tuple(vary)
+        key = url + tuple([environ.get(k) for k in vary])
+        self.cache.set(key, (response[0], response[1], ''.join(body)), ttl)
+
+
+class CollectingIterator(object):
+    """Iterate over a WSGI response, saving its output in the `body` list
+
+    `callback` is called (after closing the response) only if the response
+    is iterated over completely.
+    """
+
+    def __init__(self, iterable, body, callback):
+        self.iterable, self.body, self.callback = iterable, body, callback
+        self.iterator = iter(iterable)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            data = self.iterator.next()
+        except StopIteration:
+            self.close()
+            callback, self.callback = self.callback, None
+            if callback is not None:
+                callback()
+            raise StopIteration
+        self.body.append(data)
+        return data
+
+    def close(self):
+        iterable, self.iterable = self.iterable, None
+        if hasattr(iterable, 'close'):
+            iterable.close()
+
+
+class RequestBody(object):
+    """File-like wrapper for ``wsgi.input`` that stops at the body's end"""
+
+    def __init__(self, stream, length):
+        self.stream, self.remaining = stream, length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = size and self.stream.read(size) or ''
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = size and self.stream.readline(size) or ''
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=None):
+        return list(self)
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def drain(self, limit=64<<10):
+        """Skip any unread data, if there's no more than `limit` bytes of it
+
+        Returns True if the entire body has been read.
+        """
+        if self.remaining > limit:
+            return False
+        while self.remaining:
+            if not self.read(8192):
+                return False
+        return True
+
+
+class Server(object):
+    """Prefork, multithreaded HTTP/1.1 server for a WSGI app or Page tree
+
+    `app` may be a WSGI application, a Page class, or a ``"module:name"``
+    string naming one.  The app is loaded (and, if it's a Page class, run
+    through a ``Dispatcher`` and ``warm_up()``) before any worker processes
+    are forked, so that its templates and tables are shared by them.  Any
+    other keyword arguments set the server's attributes (``workers``,
+    ``threads``, etc.).
+    """
+
+    workers = 4             # worker processes (0 = serve in this process)
+    threads = 10            # threads per worker
+    max_requests = None     # recycle a worker after this many requests
+    keep_alive_timeout = 15 # seconds to wait for a connection's next request
+    graceful_timeout = 30   # seconds to let workers finish before killing
+    poll_interval = 0.5     # seconds between checks for workers or stopping
+    backlog = 128
+    access_log = True       # log each request to stderr
+    preload = ('cgi', 'hashlib', 'zlib', 'email.Utils', 'wsgiref.headers')
+
+    socket = application = None
+    stopping = reloading = False
+    requests = 0
+
+    def __init__(self, app, host='', port=8080, **kw):
+        self.app, self.host, self.port = app, host, port
+        for k, v in kw.items():
+            if not hasattr(type(self), k):
+                raise TypeError("Unexpected keyword argument %r" % (k,))
+            setattr(self, k, v)
+
+    def bind(self):
+        """Create the listening socket (setting ``port``, if it was 0)"""
+        import socket
+        sock = self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(self.backlog)
+        self.port = sock.getsockname()[1]
+        self.base_environ = dict(
+            SERVER_NAME=self.host or socket.gethostname(),
+            SERVER_PORT=str(self.port), GATEWAY_INTERFACE='CGI/1.1',
+            REMOTE_HOST='', CONTENT_LENGTH='', SCRIPT_NAME='',
+        )
+
+    def load(self, fresh=False):
+        """Import (or `fresh`-ly reload) and warm up the app"""
+        for name in self.preload:
+            try:
+                __import__(name)
+            except ImportError:     # e.g. hashlib, before Python 2.5
+                pass
+        app = self.app
+        if isinstance(app, basestring):
+            module, name = app.split(':', 1)
+            module = __import__(module, globals(), locals(), [name])
+            if fresh:
+                module = reload(module)
+            app = getattr(module, name)
+        if isinstance(app, type) and issubclass(app, Page):
+            dispatcher = Dispatcher(app)
+            warm_up(app, dispatcher)
+            app = dispatcher
+        self.application = app
+
+    def run(self):
+        """Load the app and serve it until stopped
+
+        Unless ``workers`` is 0 (or the platform can't fork), the current
+        process supervises ``workers`` child processes, replacing any that
+        exit.  ``SIGHUP`` reloads the app and gracefully replaces the
+        workers (unless the reload fails, in which case the error is printed
+        and the current workers keep running), and ``SIGTERM`` or ``SIGINT``
+        gracefully shuts down.
+        """
+        import os, signal
+        if self.socket is None:
+            self.bind()
+        self.load()
+        if not self.workers or not hasattr(os, 'fork'):
+            return self.serve()
+
+        def stop(signum, frame):
+            self.stopping = True
+        def reload_app(signum, frame):
+            self.reloading = True
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGHUP, reload_app)
+
+        pids, generation = {}, 0
+        try:
+            while not self.stopping:
+                if self.reloading:
+                    self.reloading = False
+                    try:
+                        self.load(True)
+                    except Exception:
+                        import traceback
+                        traceback.print_exc()
+                        print >>sys.stderr, "Reload failed; keeping old workers"
+                    else:
+                        generation += 1
+                        for pid in pids.keys():
+                            self.kill(pid, signal.SIGTERM)
+                for pid in self.reap():
+                    pids.pop(pid, None)
+                current = [g for g in pids.values() if g == generation]
+                for i in range(self.workers - len(current)):
+                    pids[self.spawn()] = generation
+                time.sleep(self.poll_interval)
+        finally:
+            for pid in pids:
+                self.kill(pid, signal.SIGTERM)
+            deadline = time.time() + self.graceful_timeout
+            while pids and time.time() < deadline:
+                for pid in self.reap():
+                    pids.pop(pid, None)
+                time.sleep(self.poll_interval/10)
+            for pid in pids:
+                self.kill(pid, signal.SIGKILL)
+            self.reap()
+
+    def spawn(self):
+        """Fork a worker process and return its pid"""
+        import os, signal
+        pid = os.fork()
+        if pid:
+            return pid
+        status = 1
+        try:
+            try:
+                def stop(signum, frame):
+                    self.stopping = True
+                signal.signal(signal.SIGTERM, stop)
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+                self.serve()
+                status = 0
+            except:
+                import traceback
+                traceback.print_exc()
+        finally:
+            os._exit(status)
+
+    def kill(self, pid, signum):
+        import os
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            pass
+
+    def reap(self):
+        """Return the pids of any exited child processes"""
+        import os
+        pids = []
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                break
+            if not pid:
+                break
+            pids.append(pid)
+        return pids
+
+    def serve(self):
+        """Serve requests in this process until stopped or recycled
+
+        ``threads`` threads accept and handle connections; when ``stop()``
+        is called (or ``max_requests`` have been served), they finish the
+        requests they're working on, and this method returns.
+        """
+        from threading import Thread, Lock
+        self.lock = Lock()
+        self.handler = self.make_handler()
+        self.socket.settimeout(self.poll_interval)
+        threads = [Thread(target=self.accept) for i in range(self.threads)]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+        while threads:
+            try:
+                threads[-1].join(self.poll_interval)
+            except KeyboardInterrupt:
+                self.stop()
+            threads = [thread for thread in threads if thread.isAlive()]
+
+    def stop(self):
+        """Stop accepting connections and finish any current requests"""
+        self.stopping = True
+
+    def accept(self):
+        import socket, errno
+        retry = errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR, errno.ECONNABORTED
+        while not self.stopping:
+            try:
+                conn, address = self.socket.accept()
+            except socket.timeout:
+                continue
+            except socket.error, e:
+                if e.args[0] in retry:
+                    continue
+                raise
+            try:
+                try:
+                    conn.settimeout(self.keep_alive_timeout)
+                    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    self.handler(conn, address, self)
+                except (socket.error, IOError):
+                    pass    # client went away
+            finally:
+                conn.close()
+
+    def count_request(self):
+        """Count a request, and start recycling if it's the last one"""
+        self.lock.acquire()
+        try:
+            self.requests += 1
+            if self.max_requests and self.requests >= self.max_requests:
+                self.stopping = True
+        finally:
+            self.lock.release()
+
+    def get_app(self):
+        return self.application
+
+    def make_handler(self):
+        """Return a request handler class supporting HTTP/1.1 keep-alive"""
+        from wsgiref.simple_server import WSGIRequestHandler, ServerHandler
+
+        class ResponseHandler(ServerHandler):
+            http_version = "1.1"
+
+            def cleanup_headers(self):
+                ServerHandler.cleanup_headers(self)
+                request = self.request_handler
+                if self.headers.get('Content-Length') is None:
+                    request.close_connection = 1    # no way to end the body
+                if request.close_connection:
+                    self.headers['Connection'] = 'close'
+                elif request.request_version == 'HTTP/1.0':
+                    self.headers['Connection'] = 'keep-alive'
+
+        class RequestHandler(WSGIRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def handle(self):
+                self.close_connection = 1
+                self.handle_one_request()
+                while not self.close_connection:
+                    self.handle_one_request()
+
+            def handle_one_request(self):
+                import socket
+                try:
+                    self.raw_requestline = self.rfile.readline(65537)
+                except socket.timeout:
+                    self.raw_requestline = ''
+                if not self.raw_requestline:
+                    self.close_connection = 1
+                    return
+                if len(self.raw_requestline) > 65536:
+                    self.requestline = self.request_version = self.command = ''
+                    self.send_error(414)
+                    return
+                if not self.parse_request():
+                    return
+                server = self.server
+                if server.stopping or self.headers.get('Transfer-Encoding'):
+                    self.close_connection = 1
+                try:
+                    length = int(self.headers.get('Content-Length') or 0)
+                except ValueError:
+                    self.close_connection = 1
+                    self.send_error(400, "Invalid Content-Length")
+                    return
+                body = RequestBody(self.rfile, length)
+                handler = ResponseHandler(
+                    body, self.wfile, self.get_stderr(), self.get_environ()
+                )
+                handler.request_handler = self
+                server.count_request()
+                handler.run(server.get_app())
+                if not body.drain():
+                    self.close_connection = 1
+                if server.stopping:
+                    self.close_connection = 1
+
+            def log_message(self, *args):
+                if self.server.access_log:
+                    WSGIRequestHandler.log_message(self, *args)
+
+        return RequestHandler
+
+
+class ClosingIterator(object):
+    """Iterate over a WSGI response, calling `callback` when it's closed"""
+
+    def __init__(self, iterable, callback):
+        self.iterable, self.callback = iterable, callback
+        self.iterator = iter(iterable)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self.iterator.next()
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            self.callback()
+
+
+def close_quietly(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+
+class ConnectionPool(object):
+    """Thread-safe pool of DBAPI connections, checked out one per thread
+
+    `connect` is called (with no arguments) to open a new connection, and at
+    most `max_size` connections are open at once; threads wait up to
+    `timeout` seconds (forever, if None) for one to be returned.  Idle
+    connections are closed after `idle_timeout` seconds (keeping at least
+    `min_size` open), and all connections are closed once they are `recycle`
+    seconds old.  If `ping` is given, it's a query that's run to check an
+    idle connection before it's reused.
+    """
+
+    checkouts = waits = wait_time = created = discarded = max_in_use = 0
+
+    def __init__(self, connect, min_size=0, max_size=10, timeout=None,
+        idle_timeout=None, recycle=None, ping=None
+    ):
+        from threading import Condition, local
+        self.connect, self.min_size, self.max_size = connect, min_size, max_size
+        self.timeout, self.idle_timeout = timeout, idle_timeout
+        self.recycle, self.ping = recycle, ping
+        self.lock = Condition()
+        self.local = local()
+        self.idle = []  # (connection, created, last_used), oldest use first
+        self.size = 0   # number of open connections, idle or in use
+
+    def connection(self):
+        """Return the current thread's connection, checking one out if needed"""
+        current = getattr(self.local, 'current', None)
+        if current is None:
+            current = self.local.current = self.checkout()
+        return current[0]
+
+    def release(self):
+        """Return the current thread's connection (if any) to the pool"""
+        current = getattr(self.local, 'current', None)
+        if current is not None:
+            self.local.current = None
+            self.checkin(*current)
+
+    def managed(self, app):
+        """Wrap WSGI `app` so connections are released after each request"""
+        def wrapper(environ, start_response):
+            try:
+                result = app(environ, start_response)
+            except:
+                self.release()
+                raise
+            return ClosingIterator(result, self.release)
+        return wrapper
+
+    def checkout(self):
+        """Return a ``(connection, created)`` pair, waiting if necessary"""
+        self.lock.acquire()
+        try:
+            started = connection = None
+            while True:
+                self.prune()
+                if self.idle:
+                    connection, created, used = self.idle.pop()
+                    break
+                elif self.size < self.max_size:
+                    self.size += 1
+                    break
+                now = time.time()
+                if started is None:
+                    started = now
+                    self.waits += 1
+                if self.timeout is None:
+                    self.lock.wait()
+                elif now < started + self.timeout:
+                    self.lock.wait(started + self.timeout - now)
+                else:
+                    raise RuntimeError("Timed out waiting for a connection")
+            if started is not None:
+                self.wait_time += time.time() - started
+            self.checkouts += 1
+            self.max_in_use = max(self.max_in_use, self.size-len(self.idle))
+        finally:
+            self.lock.release()
+
+        if connection is None:
+            try:
+                connection = self.connect()
+            except:
+                self.discard(None)
+                raise
+            created = time.time()
+            self.created += 1
+        elif self.ping is not None:
+            try:
+                connection.cursor().execute(self.ping)
+            except Exception:
+                self.discard(connection)
+                return self.checkout()
+        return connection, created
+
+    def checkin(self, connection, created):
+        """Return a connection obtained from ``checkout()``"""
+        try:
+            connection.rollback()   # discard any uncommitted changes
+        except Exception:
+            return self.discard(connection)
+        now = time.time()
+        if self.recycle is not None and now - created > self.recycle:
+            return self.discard(connection)
+        self.lock.acquire()
+        try:
+            self.idle.append((connection, created, now))
+            self.lock.notify()
+        finally:
+            self.lock.release()
+
+    def discard(self, connection):
+        """Close a checked-out `connection` (None if it couldn't be opened)"""
+        self.lock.acquire()
+        try:
+            self.size -= 1
+            if connection is not None:
+                self.discarded += 1
+            self.lock.notify()
+        finally:
+            self.lock.release()
+        if connection is not None:
+            close_quietly(connection)
+
+    def prune(self):
+        # Close expired idle connections (caller must hold the lock)
+        now, keep = time.time(), []
+        for item in self.idle:
+            connection, created, used = item
+            if (self.recycle is not None and now - created > self.recycle or
+                self.idle_timeout is not None and self.size > self.min_size
+                and now - used > self.idle_timeout
+            ):
+                self.size -= 1
+                self.discarded += 1
+                close_quietly(connection)
+            else:
+                keep.append(item)
+        self.idle[:] = keep
+
+    def stats(self):
+        """Return a dictionary of usage statistics"""
+        self.lock.acquire()
+        try:
+            in_use = self.size - len(self.idle)
+            return dict(
+                size=self.size, idle=len(self.idle), in_use=in_use,
+                utilization=float(in_use) / self.max_size,
+                max_in_use=self.max_in_use, checkouts=self.checkouts,
+                waits=self.waits, wait_time=self.wait_time,
+                created=self.created, discarded=self.discarded,
+            )
+        finally:
+            self.lock.release()
+
+
+sql_name = r'(?:"[^"]+"|`[^`]+`|\[[^\]]+\]|\w+)'     # plain or quoted name
+sql_keyword = re.compile(r'\b(?:FROM|JOIN|INTO|UPDATE)\s+', re.I).finditer
+sql_table = re.compile(     # (schema-qualified) table, alias, and any comma
+    r'(%s(?:\s*\.\s*%s)*)(?:\s+(?:AS\s+)?\w+)?\s*(,\s*)?' % (sql_name, sql_name),
+    re.I
+).match
+sql_name_parts = re.compile(r'"([^"]+)"|`([^`]+)`|\[([^\]]+)\]|(\w+)').findall
+
+def sql_tables(sql):
+    """Return the names of the tables used by `sql`
+
+    Tables are found after ``FROM``, ``JOIN``, ``INTO``, and ``UPDATE``,
+    including comma-separated lists of tables.  Quotes and schema names are
+    removed, so ``main."Menu"`` is returned as ``Menu``.
+    """
+    tables = []
+    for keyword in sql_keyword(sql):
+        pos = keyword.end()
+        while True:
+            table = sql_table(sql, pos)
+            if table is None:
+                break
+            tables.append(''.join(sql_name_parts(table.group(1))[-1]))
+            if not table.group(2):
+                break
+            pos = table.end()
+    return tables
+
+def sizeof_rows(rows):
+    """Roughly estimate the memory used by a sequence of row tuples"""
+    size = 16 * len(rows)
+    for row in rows:
+        size += 8 * len(row)
+        for value in row:
+            if isinstance(value, basestring):
+                size += len(value)
+    return size
+
+
+class QueryCache(LRUCache):
+    """LRU cache of query results, with tag-based invalidation
+
+    Works like an ``LRUCache`` (with `max_size` measured in approximate bytes
+    of row data), except that each entry can be given a set of `tags` (such
+    as the names of the tables it was read from), so that ``invalidate()``
+    can discard all the entries for a tag.  ``fetch()`` ensures that only one
+    thread at a time computes the value for a given key.
+    """
+
+    waits = 0
+
+    def __init__(self, max_size=4<<20, ttl=None, sizeof=sizeof_rows):
+        from threading import RLock
+        LRUCache.__init__(self, max_size, ttl, sizeof)
+        self.lock = RLock()
+        self.tagged = {}    # tag -> set of keys
+        self.key_tags = {}  # key -> tags
+        self.loading = {}   # key -> lock held while computing its value
+        self.generation = 0 # incremented by each invalidate()
+
+    def fetch(self, key, compute, ttl=None, tags=()):
+        """Return the value for `key`, calling ``compute()`` on a miss
+
+        If other threads miss on the same key while `compute` is running,
+        they wait for its result instead of computing it again.
+        """
+        value = self.get(key, sentinel)
+        if value is not sentinel:
+            return value
+        from threading import Lock
+        self.lock.acquire()
+        try:
+            lock = waited = self.loading.get(key)
+            if lock is None:
+                lock = self.loading[key] = Lock()
+            else:
+                self.waits += 1
+        finally:
+            self.lock.release()
+        lock.acquire()
+        try:
+            if waited is not None:
+                value = self.get(key, sentinel)
+            if value is sentinel:
+                generation = self.generation
+                value = compute()
+                self.set(key, value, ttl, tags, generation)
+            return value
+        finally:
+            lock.release()
+            self.lock.acquire()
+            try:
+                if self.loading.get(key) is lock:
+                    del self.loading[key]
+            finally:
+                self.lock.release()
+
+    def set(self, key, value, ttl=None, tags=(), generation=None):
+        """Cache `value` under `key` and `tags`
+
+        If `generation` is given and ``invalidate()`` has been called since
+        it was read from the ``generation`` attribute, the value isn't cached
+        (since it may have been computed from data that's now out of date).
+        """
+        self.lock.acquire()
+        try:
+            if generation is not None and generation != self.generation:
+                return
+            LRUCache.set(self, key, value, ttl)
+            if tags and key in self.data:
+                self.key_tags[key] = tags
+                for tag in tags:
+                    self.tagged.setdefault(tag, set()).add(key)
+        finally:
+            self.lock.release()
+
+    def invalidate(self, *tags):
+        """Discard all entries with any of the given `tags`"""
+        self.lock.acquire()
+        try:
+            self.generation += 1
+            for tag in tags:
+                for key in list(self.tagged.get(tag, ())):
+                    self.unlink(self.data[key])
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.generation += 1
+            LRUCache.clear(self)
+            self.tagged.clear()
+            self.key_tags.clear()
+        finally:
+            self.lock.release()
+
+    def unlink(self, link):
+        # caller must hold the lock
+        LRUCache.unlink(self, link)
+        for tag in self.key_tags.pop(link[2], ()):
+            keys = self.tagged[tag]
+            keys.discard(link[2])
+            if not keys:
+                del self.tagged[tag]
+
+    def stats(self):
+        """Return a dictionary of usage counters"""
+        stats = LRUCache.stats(self)
+        stats.update(waits=self.waits, tags=len(self.tagged))
+        return stats
+
+
 class DB(context.Service):
     db = None   # DBAPI database connection object
+    pool = None # ConnectionPool to use instead, if any
+    query_cache = None  # QueryCache used by cached(), if any
+    batch_size = 500    # default number of rows per executemany() batch
 
     def db_connect(self):
         """Override this in a subclass to return a DBAPI connection object"""
         raise NotImplementedError
 
     def get_db(self):
+        if self.pool is not None:
+            return self.pool.connection()
         if self.db is None:
             self.db = self.db_connect()
         return self.db
 
+    def release(self):
+        """Return this thread's pooled connection (if any) to the pool"""
+        if self.pool is not None:
+            self.pool.release()
+
     def cursor(self, *args, **kw):
         """Create and return a cursor (after optionally running a query on it)
 
@@ -474,20 +2773,191 @@ class DB(context.Service):
             setattr(cursor, k, v)
 
         if args:
-            cursor.execute(*args)
+            if monitor is not None:
+                timed('query', args[0], cursor.execute, *args)
+            else:
+                cursor.execute(*args)
 
         return cursor
 
     def query(self, *args, **kw):
+        """Yield ``Row`` objects for a query's results"""
         csr = self.cursor(*args, **kw)
-        return (Row(csr,r) for rows in iter(csr.fetchmany,[]) for r in rows)
+        if csr.description is None:
+            return iter(())
+        new, cls = tuple.__new__, row_class(csr.description)
+        return (new(cls, r) for rows in iter(csr.fetchmany,[]) for r in rows)
+
+    def cached(self, sql, params=(), ttl=None, tags=()):
+        """Return a tuple of ``Row`` objects, using the query cache if any
+
+        Results are cached by `sql` and `params`, for `ttl` seconds (or the
+        cache's default), under the given `tags` plus the names of any tables
+        mentioned in `sql`.  Tags are case-insensitive.
+        """
+        args = params and (sql, params) or (sql,)
+        if self.query_cache is None:
+            return tuple(self.query(*args))
+        if isinstance(params, dict):
+            key = sql, tuple(sorted(params.items()))
+        else:
+            key = sql, tuple(params)
+        tags = dict.fromkeys([t.lower() for t in sql_tables(sql)+list(tags)])
+        return self.query_cache.fetch(
+            key, lambda: tuple(self.query(*args)), ttl, tuple(tags)
+        )
 
+    def invalidate(self, *tags):
+        """Discard cached results for the given tags or table names"""
+        if self.query_cache is not None:
+            self.query_cache.invalidate(*[tag.lower() for tag in tags])
 
-class Row(object):
-    """Easy-access dict/object wrapper for DBAPI row tuples"""
+    def transaction(self):
+        """Return a ``Transaction`` for the current connection"""
+        return Transaction(self)
 
-    def __init__(self, cursor, row):
-        self.__dict__ = dict(zip([d[0]for d in cursor.description], row))
+    def executemany(self, sql, rows, batch_size=None):
+        """Run `sql` for each of `rows` (any iterable), in batches
+
+        The rows are read and written `batch_size` at a time (default:
+        ``self.batch_size``) within a transaction, and cached results for the
+        table being written are invalidated.  Returns a dictionary with the
+        number of ``rows`` and ``batches`` written, the elapsed ``seconds``,
+        and the ``rows_per_sec``.
+        """
+        from itertools import islice
+        batch_size = batch_size or self.batch_size
+        rows = iter(rows)
+        count = batches = 0
+        start = time.time()
+        txn = self.transaction()
+        try:
+            cursor = txn.connection.cursor()
+            while True:
+                batch = list(islice(rows, batch_size))
+                if not batch:
+                    break
+                timed('query', sql, cursor.executemany, sql, batch)
+                count += len(batch)
+                batches += 1
+        except:
+            txn.rollback()
+            raise
+        txn.commit()
+        self.invalidate(*sql_tables(sql))
+        elapsed = time.time() - start
+        return dict(
+            rows=count, batches=batches, seconds=elapsed,
+            rows_per_sec=elapsed and count/elapsed or 0.0,
+        )
+
+    def tuples(self, *args, **kw):
+        """Yield a query's results as plain DBAPI row tuples"""
+        csr = self.cursor(*args, **kw)
+        return (r for rows in iter(csr.fetchmany,[]) for r in rows)
+
+    def columns(self, *args, **kw):
+        """Return a ``Row`` whose values are lists of each column's values"""
+        csr = self.cursor(*args, **kw)
+        cls = row_class(csr.description)
+        cols = [[] for name in cls._fields]
+        for rows in iter(csr.fetchmany,[]):
+            for col, values in zip(cols, zip(*rows)):
+                col.extend(values)
+        return tuple.__new__(cls, cols)
+
+
+class Transaction(object):
+    """Commit or roll back a DB's connection at the end of a unit of work
+
+    Call ``commit()`` or ``rollback()`` explicitly, or use the transaction as
+    a context manager (``with db.transaction():``) to commit if the block
+    succeeds and roll back if it raises an error.  Transactions begun while
+    another is in progress on the same connection (i.e., in the same thread,
+    if the DB uses a pool) join the outer transaction, which is the only one
+    that actually commits or rolls back.
+    """
+
+    def __init__(self, db):
+        self.db, self.connection = db, db.get_db()
+        # number of open transactions, by connection
+        self.depths = db.__dict__.setdefault('transaction_depths', {})
+        self.key = id(self.connection)
+        depth = self.depths.get(self.key, 0)
+        self.outer = not depth
+        self.active = True
+        self.depths[self.key] = depth + 1
+
+    def finish(self):
+        if not self.active:
+            raise RuntimeError("Transaction already finished")
+        self.active = False
+        depth = self.depths[self.key] - 1
+        if depth:
+            self.depths[self.key] = depth
+        else:
+            del self.depths[self.key]
+        return self.outer
+
+    def commit(self):
+        if self.finish():
+            self.connection.commit()
+
+    def rollback(self):
+        if self.finish():
+            self.connection.rollback()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, val, tb):
+        if typ is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+
+class Row(tuple):
+    """Easy-access tuple/object wrapper for DBAPI row tuples
+
+    Each distinct set of column names gets its own (cached) ``Row`` subclass,
+    with a read-only property per column and no per-row ``__dict__``.
+    """
+    __slots__ = ()
+    _fields = ()
+
+    def __new__(cls, cursor, row):
+        return tuple.__new__(row_class(cursor.description), row)
+
+    def __dict__(self):
+        return dict(zip(self._fields, self))
+    __dict__ = property(__dict__)
+
+    def __repr__(self):
+        return "Row(%s)" % ', '.join(
+            ["%s=%r" % item for item in zip(self._fields, self)]
+        )
+
+    def __reduce__(self):
+        return restore_row, (self._fields, tuple(self))
+
+row_classes = {}
+
+def row_class(description):
+    """Return the ``Row`` subclass for a DBAPI cursor description"""
+    names = tuple([d[0] for d in description])
+    try:
+        return row_classes[names]
+    except KeyError:
+        attrs = dict(__slots__=(), _fields=names)
+        for pos, name in enumerate(names):
+            attrs[name] = property(operator.itemgetter(pos))
+        return row_classes.setdefault(names, type(Row)('Row', (Row,), attrs))
+
+def restore_row(fields, values):
+    """Rebuild a copied or pickled ``Row`` with the given column names"""
+    return tuple.__new__(row_class([(name,) for name in fields]), values)
 
 
 def test(app, environ={}, form={}, **kw):
@@ -520,7 +2990,6 @@ def test(app, environ={}, form={}, **kw):
     from wsgiref.util import setup_testing_defaults
     from wsgiref.handlers import SimpleHandler
     from StringIO import StringIO
-    from urllib import quote_plus
 
     environ = environ.copy()
     for k, v in kw.items():
@@ -532,13 +3001,7 @@ def test(app, environ={}, form={}, **kw):
 
 
     if form:
-        encoded = []
-        for k, v in form.items():
-            if isinstance(v,basestring):
-                v = [v]
-            for v in v:
-                encoded.append('%s=%s' % (quote_plus(k), quote_plus(v)))
-        encoded = '&'.join(encoded)
+        encoded = encode_form(form)
         environ.setdefault('wsgi.input', StringIO(encoded))
         environ.setdefault('CONTENT_LENGTH', str(len(encoded)))
         environ.setdefault('CONTENT_TYPE', 'application/x-www-form-urlencoded')
@@ -572,6 +3035,201 @@ def test(app, environ={}, form={}, **kw):
         print stderr.getvalue().replace('\r\n','\n')
 
 
+def encode_form(form):
+    """URL-encode a `form` dictionary (see ``test()``) as a POST body"""
+    from urllib import quote_plus
+    encoded = []
+    for k, v in form.items():
+        if isinstance(v,basestring):
+            v = [v]
+        for v in v:
+            encoded.append('%s=%s' % (quote_plus(k), quote_plus(v)))
+    return '&'.join(encoded)
+
+
+class Client(object):
+    """Run requests through a WSGI app in-process, and return the results
+
+    Unlike ``test()``, a client doesn't print anything or start a debugger:
+    each request returns a ``(status, headers, body)`` tuple.  The `environ`
+    and keyword arguments (interpreted as for ``test()``) set defaults for
+    all of the client's requests.
+    """
+
+    def __init__(self, app, environ={}, **kw):
+        from wsgiref.util import setup_testing_defaults
+        self.app = app
+        self.environ = environ = self.make_environ(environ, kw)
+        setup_testing_defaults(environ)
+
+    def make_environ(self, environ, kw):
+        environ = environ.copy()
+        for k, v in kw.items():
+            if k.startswith('wsgi_'):
+                environ[k.replace('_','.',1)] = v
+            else:
+                environ[k] = v
+        return environ
+
+    def prepare(self, path='/', form={}, **kw):
+        """Return a function that runs a request and returns its result
+
+        The request's environment (and encoded `form` data, if any) is
+        built once, and reused each time the function is called.  `path` may
+        include a query string.  `form` and keyword arguments are as for
+        ``test()``.
+        """
+        environ = self.environ.copy()
+        environ.update(self.make_environ({}, kw))
+        path, query = (path.split('?', 1) + [''])[:2]
+        environ['PATH_INFO'], environ['QUERY_STRING'] = path, query
+        body = None
+        if form:
+            body = encode_form(form)
+            environ.setdefault('CONTENT_TYPE', 'application/x-www-form-urlencoded')
+            if 'REQUEST_METHOD' not in kw:
+                environ['REQUEST_METHOD'] = 'POST'
+            environ['CONTENT_LENGTH'] = str(len(body))
+        return lambda: self.run(environ, body)
+
+    def request(self, path='/', form={}, **kw):
+        """Run a request, returning ``(status, headers, body)``"""
+        return self.prepare(path, form, **kw)()
+
+    def run(self, environ, body=None):
+        """Run the app with a copy of `environ`, and `body` as its input"""
+        from cStringIO import StringIO
+        environ = environ.copy()
+        if body is not None:
+            environ['wsgi.input'] = StringIO(body)
+        response, output = [None, None], []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info:
+                try:
+                    if output:
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                finally:
+                    exc_info = None
+            response[:] = status, headers
+            return output.append
+
+        result = self.app(environ, start_response)
+        try:
+            for data in result:
+                output.append(data)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return response[0], response[1], ''.join(output)
+
+    def drive(self, requests, duration=5.0, threads=1, processes=1):
+        """Run prepared `requests` repeatedly for `duration` seconds
+
+        Each of `threads` threads (in each of `processes` processes) runs the
+        functions in `requests` (as returned by ``prepare()``) in turn until
+        the time is up.  Returns a dictionary with the number of ``requests``
+        run, the number of ``errors`` (exceptions or ``5xx`` responses), the
+        ``requests_per_sec``, and the ``latency_p50``, ``latency_p90``,
+        ``latency_p99``, and ``latency_max`` (in seconds).
+        """
+        import os
+        start = time.time()
+        if processes > 1 and hasattr(os, 'fork'):
+            latencies, errors = self.drive_processes(
+                requests, duration, threads, processes
+            )
+        else:
+            latencies, errors = self.drive_threads(requests, duration, threads)
+        elapsed = time.time() - start
+        latencies.sort()
+        def percentile(p):
+            if latencies:
+                return latencies[int(p/100.0*(len(latencies)-1))]
+        return dict(
+            requests=len(latencies), errors=errors,
+            requests_per_sec=len(latencies)/elapsed,
+            latency_p50=percentile(50), latency_p90=percentile(90),
+            latency_p99=percentile(99), latency_max=percentile(100),
+        )
+
+    def drive_threads(self, requests, duration, threads):
+        """Return the latencies and error count of `threads` threads"""
+        from threading import Thread
+        deadline = time.time() + duration
+        results = []
+
+        def worker(offset):
+            latencies, errors, timer = [], 0, time.time
+            count, pos = len(requests), offset
+            while True:
+                start = timer()
+                if start >= deadline:
+                    break
+                try:
+                    if requests[pos % count]()[0][:1] == '5':
+                        errors += 1
+                except Exception:
+                    errors += 1
+                latencies.append(timer() - start)
+                pos += 1
+            results.append((latencies, errors))
+
+        workers = [Thread(target=worker, args=(n,)) for n in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        latencies, errors = [], 0
+        for l, e in results:
+            latencies.extend(l)
+            errors += e
+        return latencies, errors
+
+    def drive_processes(self, requests, duration, threads, processes):
+        """Return the latencies and error count of forked processes
+
+        A process that exits with a non-zero status or doesn't report its
+        results counts as one error.
+        """
+        import os, marshal
+        children = []
+        for n in range(processes):
+            read, write = os.pipe()
+            pid = os.fork()
+            if not pid:
+                status = 1
+                try:
+                    try:
+                        os.close(read)
+                        data = marshal.dumps(
+                            self.drive_threads(requests, duration, threads)
+                        )
+                        while data:
+                            data = data[os.write(write, data):]
+                        status = 0
+                    except:
+                        import traceback
+                        traceback.print_exc()
+                finally:
+                    os._exit(status)
+            os.close(write)
+            children.append((pid, read))
+        latencies, errors = [], 0
+        for pid, read in children:
+            chunks = []
+            for data in iter(lambda: os.read(read, 65536), ''):
+                chunks.append(data)
+            os.close(read)
+            if os.waitpid(pid, 0)[1] or not chunks:
+                errors += 1
+                continue
+            l, e = marshal.loads(''.join(chunks))
+            latencies.extend(l)
+            errors += e
+        return latencies, errors
+
+
 class TestForm(Page):
     """A stupid example to test the framework"""
 